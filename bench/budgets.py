@@ -0,0 +1,228 @@
+# Payload budgets. Adding a nested list to a shared fragment (another `images` under every scene, say) silently
+# multiplies the response of every route that spreads it, so each operation declares the shape it may have and each
+# route the response size it may reach against the mock library, and this exits with an error when one is exceeded.
+#
+#   python bench/budgets.py [--current]
+#
+# Shapes are measured statically against schema/stash.graphql (see Shape), sizes are the decoded bytes of a route
+# run by bench/routes.py against a 1000 scene library with the default seed and fan-out, which is deterministic.
+# When a change grows a figure on purpose, raise its budget here in the same commit; --current prints them all.
+# Needs graphql-core (like build.py) and requests.
+
+import argparse
+import sys
+import threading
+from typing import Dict, FrozenSet, List, NamedTuple, Tuple
+
+from graphql import (FieldNode, FragmentDefinitionNode, FragmentSpreadNode, GraphQLSchema, InlineFragmentNode,
+                     OperationDefinitionNode, SelectionSetNode, build_schema, get_named_type, get_nullable_type,
+                     is_list_type, parse)
+
+from mock_stash import SCHEMA_PATH, Fanout, Library, server
+from routes import DEFAULT_SETTINGS, ROOT, ROUTES, run_route
+
+sys.path.insert(0, str(ROOT))
+
+import queries
+
+
+class Shape(NamedTuple):
+    # deepest selection set, the root field being 1
+    depth: int
+    # most list fields on one path: every level multiplies the response by that list's length
+    lists: int
+    # list fields inside another list, each one is repeated for every element of the outer list
+    nested_lists: int
+
+
+# operation -> the largest shape it may have
+SHAPE_BUDGETS = {
+    'FindScene': Shape(depth=4, lists=2, nested_lists=2),
+    'ListScenes': Shape(depth=5, lists=2, nested_lists=3),
+    'FindMovie': Shape(depth=5, lists=2, nested_lists=3),
+    'ListMovies': Shape(depth=3, lists=1, nested_lists=0),
+    'ListMarkers': Shape(depth=4, lists=1, nested_lists=0),
+    'FindPerformer': Shape(depth=1, lists=0, nested_lists=0),
+    'PerformerScenes': Shape(depth=5, lists=2, nested_lists=3),
+    'PerformerGalleries': Shape(depth=4, lists=2, nested_lists=1),
+    'ListPerformers': Shape(depth=2, lists=1, nested_lists=0),
+    'FindGallery': Shape(depth=5, lists=2, nested_lists=3),
+    'ListGalleries': Shape(depth=4, lists=2, nested_lists=1),
+    'FindTag': Shape(depth=1, lists=0, nested_lists=0),
+    'TaggedScenes': Shape(depth=5, lists=2, nested_lists=3),
+    'TaggedGalleries': Shape(depth=4, lists=2, nested_lists=1),
+    'ListTags': Shape(depth=2, lists=1, nested_lists=0),
+    'PerformerGalleryCovers': Shape(depth=4, lists=1, nested_lists=0),
+    'EntityPerformers': Shape(depth=1, lists=0, nested_lists=0),
+    'EntityTags': Shape(depth=1, lists=0, nested_lists=0),
+    'EntityStudios': Shape(depth=1, lists=0, nested_lists=0),
+    'WidgetScenes': Shape(depth=5, lists=2, nested_lists=3),
+    'Search': Shape(depth=5, lists=2, nested_lists=4),
+    'MirrorScenes': Shape(depth=5, lists=2, nested_lists=4),
+    'MirrorScenesIds': Shape(depth=2, lists=1, nested_lists=0),
+    'MirrorGalleries': Shape(depth=4, lists=2, nested_lists=3),
+    'MirrorGalleriesIds': Shape(depth=2, lists=1, nested_lists=0),
+    'MirrorPerformers': Shape(depth=2, lists=1, nested_lists=0),
+    'MirrorPerformersIds': Shape(depth=2, lists=1, nested_lists=0),
+    'MirrorTags': Shape(depth=2, lists=1, nested_lists=0),
+    'MirrorTagsIds': Shape(depth=2, lists=1, nested_lists=0),
+    'MirrorMovies': Shape(depth=3, lists=1, nested_lists=0),
+    'MirrorMoviesIds': Shape(depth=2, lists=1, nested_lists=0),
+    'MirrorStudios': Shape(depth=2, lists=1, nested_lists=0),
+    'MirrorStudiosIds': Shape(depth=2, lists=1, nested_lists=0)
+}
+
+# route in bench/routes.py -> decoded response bytes it may reach, about 5% over the current size: a scalar field
+# more fits, another nested list doesn't
+SIZE_BUDGETS = {
+    'list_scenes': 88_000,
+    'scene_contents': 7_000,
+    'list_performers': 33_000,
+    'performer_contents': 77_000,
+    'list_galleries': 25_000,
+    'gallery_contents': 9_000,
+    'list_tags': 2_000,
+    'tag_contents': 115_000,
+    'list_movies': 4_000,
+    'movie_contents': 36_000,
+    'search': 89_000,
+    'scene_widget': 33_000,
+    'tag_widget': 33_000
+}
+
+LIBRARY_SIZE = 1000
+
+
+def selection_paths(schema: GraphQLSchema, document: str) -> Tuple[int, Dict[Tuple[str, ...], int]]:
+    # (depth, response path of every list field -> lists on that path including itself), fragments merged like
+    # the server merges them
+    ast = parse(document)
+    fragments = {d.name.value: d for d in ast.definitions if isinstance(d, FragmentDefinitionNode)}
+    operation = next(d for d in ast.definitions if isinstance(d, OperationDefinitionNode))
+
+    depth = 0
+    lists = {}
+
+    def walk(parent_type, selection_set: SelectionSetNode, path: Tuple[str, ...], path_lists: int,
+             spread: FrozenSet[str]):
+        nonlocal depth
+
+        for selection in selection_set.selections:
+            if isinstance(selection, FragmentSpreadNode):
+                fragment = fragments[selection.name.value]
+                if fragment.name.value not in spread:
+                    walk(schema.get_type(fragment.type_condition.name.value), fragment.selection_set, path,
+                         path_lists, spread | {fragment.name.value})
+
+            elif isinstance(selection, InlineFragmentNode):
+                condition = selection.type_condition
+                walk(schema.get_type(condition.name.value) if condition else parent_type, selection.selection_set,
+                     path, path_lists, spread)
+
+            elif isinstance(selection, FieldNode) and selection.selection_set is not None:
+                field_type = parent_type.fields[selection.name.value].type
+                field_path = path + ((selection.alias or selection.name).value,)
+                field_lists = path_lists + is_list_type(get_nullable_type(field_type))
+
+                depth = max(depth, len(field_path))
+                if field_lists > path_lists:
+                    lists[field_path] = field_lists
+
+                walk(get_named_type(field_type), selection.selection_set, field_path, field_lists, spread)
+
+    walk(schema.query_type, operation.selection_set, (), 0, frozenset())
+
+    return depth, lists
+
+
+def shape(schema: GraphQLSchema, document: str) -> Shape:
+    depth, lists = selection_paths(schema, document)
+
+    return Shape(
+        depth=depth,
+        lists=max(lists.values(), default=0),
+        nested_lists=sum(1 for count in lists.values() if count > 1)
+    )
+
+
+def shapes() -> Dict[str, Shape]:
+    schema = build_schema(SCHEMA_PATH.read_text())
+
+    return {name: shape(schema, document) for name, document in queries.compile_queries().items()}
+
+
+def sizes() -> Dict[str, int]:
+    library = Library(LIBRARY_SIZE, Fanout())
+    httpd = server(library)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+
+    try:
+        return {route: run_route(library.base_url, route, *ROUTES[route], DEFAULT_SETTINGS)['decoded']
+                for route in ROUTES}
+
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+
+def shape_errors() -> List[str]:
+    errors = []
+
+    for name, current in shapes().items():
+        budget = SHAPE_BUDGETS.get(name)
+
+        if budget is None:
+            errors.append(f'{name}: no shape budget, currently {current}')
+
+        else:
+            errors.extend(f'{name}: {field} {value} exceeds its budget of {limit}'
+                          for field, value, limit in zip(Shape._fields, current, budget) if value > limit)
+
+    return errors
+
+
+def size_errors() -> List[str]:
+    errors = []
+
+    for route, current in sizes().items():
+        budget = SIZE_BUDGETS.get(route)
+
+        if budget is None:
+            errors.append(f'{route}: no size budget, currently {current} bytes')
+
+        elif current > budget:
+            errors.append(f'{route}: {current} bytes exceeds its budget of {budget}')
+
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the operations and routes against their payload budgets')
+    parser.add_argument('--current', action='store_true', help='print the current figures instead')
+    args = parser.parse_args()
+
+    if args.current:
+        for name, current in shapes().items():
+            print(f'    {name!r}: {current},')
+
+        for route, current in sizes().items():
+            print(f'    {route!r}: {current},')
+
+        return
+
+    errors = 0
+
+    # shapes are reported before running the routes, which may not survive the change
+    for check in [shape_errors, size_errors]:
+        for error in check():
+            print(error, file=sys.stderr)
+            errors += 1
+
+    if errors > 0:
+        sys.exit(f'{errors} over budget')
+
+    print('all operations and routes within budget', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
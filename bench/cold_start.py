@@ -0,0 +1,68 @@
+# Compares the cold start of a plugin invocation's GraphQL layer: importing the client
+# and preparing one request, each in a fresh interpreter like Kodi does for every click.
+#
+#   python bench/cold_start.py [--runs N]
+#
+# The gql baseline only runs if gql 2 is installed (pip install gql==2.0.0).
+
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+PREPARE_DOCUMENT = """
+from queries import document
+document = document('FindScene')
+"""
+
+CANDIDATES = {
+    'gql': PREPARE_DOCUMENT + """
+from gql import Client, gql
+from gql.transport.requests import RequestsHTTPTransport
+client = Client(transport=RequestsHTTPTransport('http://localhost:9999/graphql'))
+gql(document)
+""",
+    'stash_client': PREPARE_DOCUMENT + """
+import json
+from stash_client import StashClient
+client = StashClient('http://localhost:9999/graphql')
+json.dumps({'query': document, 'variables': {'id': '1'}})
+""",
+}
+
+
+def available(module: str) -> bool:
+    return subprocess.run([sys.executable, '-c', f'import {module}'], cwd=ROOT, capture_output=True).returncode == 0
+
+
+def cold_start(code: str) -> float:
+    started = time.perf_counter()
+    subprocess.run([sys.executable, '-c', code], cwd=ROOT, check=True)
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cold start benchmark of the GraphQL client')
+    parser.add_argument('--runs', type=int, default=20)
+    args = parser.parse_args()
+
+    # interpreter start-up alone, subtracted from every candidate
+    baseline = statistics.median(cold_start('pass') for _ in range(args.runs))
+
+    for name, code in CANDIDATES.items():
+        if not available(name):
+            print(f'{name:>14}: not installed, skipped')
+            continue
+
+        times = [cold_start(code) - baseline for _ in range(args.runs)]
+
+        print(f'{name:>14}: median {statistics.median(times) * 1000:7.1f}ms, '
+              f'min {min(times) * 1000:7.1f}ms over {args.runs} runs')
+
+
+if __name__ == '__main__':
+    main()
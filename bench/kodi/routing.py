@@ -0,0 +1,49 @@
+# script.module.routing, as far as plugin.py uses it
+
+import re
+import sys
+from urllib.parse import parse_qs, quote, urlencode, urlsplit
+
+
+class Plugin:
+    def __init__(self, base_url: str = None):
+        self.base_url = base_url or f'plugin://{urlsplit(sys.argv[0]).netloc}'
+        self.handle = int(sys.argv[1]) if len(sys.argv) > 1 and sys.argv[1].isdigit() else -1
+        self.path = urlsplit(sys.argv[0]).path or '/'
+        self.args = {}
+        self.rules = []
+
+    def route(self, pattern: str):
+        def decorator(func):
+            regex = re.compile('^' + re.sub(r'<(\w+)>', r'(?P<\1>[^/]+)', pattern) + '$')
+            self.rules.append((regex, pattern, func))
+            return func
+
+        return decorator
+
+    def url_for(self, func, *args, **kwargs) -> str:
+        for regex, pattern, f in self.rules:
+            if f is not func:
+                continue
+
+            query = dict(kwargs)
+            path = re.sub(r'<(\w+)>', lambda m: quote(str(query.pop(m.group(1))), safe=''), pattern)
+
+            return self.base_url + path + (f'?{urlencode(query)}' if query else '')
+
+        raise KeyError(f'No route for {func.__name__}')
+
+    def url_for_path(self, path: str) -> str:
+        return self.base_url + path
+
+    def run(self, argv=None):
+        argv = argv or sys.argv
+        self.path = urlsplit(argv[0]).path or '/'
+        self.args = parse_qs(argv[2].lstrip('?')) if len(argv) > 2 else {}
+
+        for regex, pattern, func in self.rules:
+            match = regex.match(self.path)
+            if match is not None:
+                return func(**match.groupdict())
+
+        raise KeyError(f'No route matches {self.path}')
@@ -0,0 +1,47 @@
+# Stand-ins for the Kodi modules, just enough to run plugin.py outside of Kodi (see bench/routes.py).
+# Messages go to stderr when BENCH_LOG is set.
+
+import os
+import sys
+import time
+
+LOGDEBUG = 0
+LOGINFO = 1
+LOGWARNING = 2
+LOGERROR = 3
+LOGFATAL = 4
+LOGNONE = 5
+
+
+def log(msg: str, level: int = LOGDEBUG):
+    if os.environ.get('BENCH_LOG'):
+        print(f'[{level}] {msg}', file=sys.stderr)
+
+
+def getInfoLabel(label: str) -> str:
+    return ''
+
+
+def executebuiltin(function: str, wait: bool = False):
+    pass
+
+
+def sleep(milliseconds: int):
+    time.sleep(milliseconds / 1000)
+
+
+class Monitor:
+    def abortRequested(self) -> bool:
+        return False
+
+    def waitForAbort(self, timeout: float = 0) -> bool:
+        time.sleep(timeout)
+        return False
+
+
+class Player:
+    def isPlaying(self) -> bool:
+        return False
+
+    def isPlayingVideo(self) -> bool:
+        return False
@@ -0,0 +1,35 @@
+import json
+import os
+import xml.etree.ElementTree as ElementTree
+from pathlib import Path
+
+SETTINGS_PATH = Path(__file__).resolve().parents[2] / 'resources' / 'settings.xml'
+
+
+def default_settings() -> dict:
+    return {
+        setting.get('id'): setting.get('default', '')
+        for setting in ElementTree.parse(SETTINGS_PATH).iter('setting')
+        if setting.get('id') is not None
+    }
+
+
+class Addon:
+    # the defaults from resources/settings.xml, overridden by the BENCH_SETTINGS JSON object
+
+    def __init__(self, id: str = None):
+        self.settings = {**default_settings(), **json.loads(os.environ.get('BENCH_SETTINGS', '{}'))}
+
+    def getSetting(self, id: str) -> str:
+        return str(self.settings.get(id, ''))
+
+    def setSetting(self, id: str, value: str):
+        self.settings[id] = value
+
+    def getAddonInfo(self, id: str) -> str:
+        return {
+            'id': 'plugin.video.stashapp',
+            'name': 'Stash',
+            'path': str(SETTINGS_PATH.parents[1]),
+            'profile': os.environ.get('BENCH_PROFILE', '')
+        }.get(id, '')
@@ -0,0 +1,74 @@
+import os
+
+NOTIFICATION_INFO = 'info'
+NOTIFICATION_WARNING = 'warning'
+NOTIFICATION_ERROR = 'error'
+
+
+class ListItem:
+    def __init__(self, label: str = '', label2: str = '', path: str = '', offscreen: bool = False):
+        self.label = label
+        self.label2 = label2
+        self.path = path
+        self.info = {}
+        self.art = {}
+        self.cast = []
+        self.stream_info = []
+        self.properties = {}
+
+    def setLabel(self, label: str):
+        self.label = label
+
+    def setLabel2(self, label: str):
+        self.label2 = label
+
+    def setInfo(self, type: str, infoLabels: dict):
+        self.info[type] = dict(infoLabels)
+
+    def setArt(self, values: dict):
+        self.art.update(values)
+
+    def setCast(self, actors: list):
+        self.cast = list(actors)
+
+    def addStreamInfo(self, cType: str, dictionary: dict):
+        self.stream_info.append((cType, dict(dictionary)))
+
+    def setProperty(self, key: str, value: str):
+        self.properties[key.lower()] = value
+
+    def getProperty(self, key: str) -> str:
+        return self.properties.get(key.lower(), '')
+
+
+class Window:
+    # the home window's properties, the background service never runs in the benchmark
+    properties = {}
+
+    def __init__(self, existingWindowId: int = -1):
+        pass
+
+    def getProperty(self, key: str) -> str:
+        return self.properties.get(key, '')
+
+    def setProperty(self, key: str, value: str):
+        self.properties[key] = value
+
+    def clearProperty(self, key: str):
+        self.properties.pop(key, None)
+
+
+class Dialog:
+    def notification(self, heading: str, message: str, icon: str = NOTIFICATION_INFO, time: int = 5000,
+                     sound: bool = True):
+        pass
+
+    def input(self, heading: str, defaultt: str = '', type: int = 0, option: int = 0, autoclose: int = 0) -> str:
+        # the search route's query
+        return os.environ.get('BENCH_SEARCH', 'Scene 1')
+
+    def textviewer(self, heading: str, text: str, usemono: bool = False):
+        pass
+
+    def ok(self, heading: str, message: str) -> bool:
+        return True
@@ -0,0 +1,29 @@
+# ListItems handed to Kodi are kept, like Kodi keeps them for the directory
+
+directory = []
+
+
+def addDirectoryItem(handle: int, url: str, listitem, isFolder: bool = False, totalItems: int = 0) -> bool:
+    directory.append((url, listitem, isFolder))
+    return True
+
+
+def addDirectoryItems(handle: int, items, totalItems: int = 0) -> bool:
+    directory.extend(items)
+    return True
+
+
+def endOfDirectory(handle: int, succeeded: bool = True, updateListing: bool = False, cacheToDisc: bool = True):
+    pass
+
+
+def setContent(handle: int, content: str):
+    pass
+
+
+def setPluginCategory(handle: int, category: str):
+    pass
+
+
+def setResolvedUrl(handle: int, succeeded: bool, listitem):
+    pass
@@ -0,0 +1,3 @@
+def translatePath(path: str) -> str:
+    # BENCH_PROFILE is a real path already
+    return path
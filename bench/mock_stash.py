@@ -0,0 +1,593 @@
+# A mock Stash GraphQL endpoint serving a synthetic library, so the addon can be benchmarked offline.
+# Documents are executed by graphql-core against schema/stash.graphql (like build.py validates them), so
+# responses have exactly the shape and size Stash would send for the requested fields.
+#
+#   python bench/mock_stash.py [--scenes N] [--port 9999] [fan-out options, see --help]
+
+import argparse
+import gzip
+import json
+import random
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+from graphql import GraphQLSchema, build_schema, graphql_sync
+
+ROOT = Path(__file__).resolve().parent.parent
+SCHEMA_PATH = ROOT / 'schema' / 'stash.graphql'
+
+CREATED_AT = '2021-01-01T00:00:00Z'
+UPDATED_AT = '2021-06-01T00:00:00Z'
+
+# findFilter's default page size in Stash
+DEFAULT_PER_PAGE = 25
+
+
+class Fanout(NamedTuple):
+    performers_per_scene: int = 3
+    tags_per_scene: int = 5
+    galleries_per_scene: int = 1
+    images_per_gallery: int = 20
+    markers_per_scene: int = 1
+
+
+# ResolutionEnum -> the shorter side of a video of that resolution
+RESOLUTIONS = {
+    'VERY_LOW': 144,
+    'LOW': 240,
+    'R360P': 360,
+    'STANDARD': 480,
+    'WEB_HD': 540,
+    'STANDARD_HD': 720,
+    'FULL_HD': 1080,
+    'QUAD_HD': 1440,
+    'VR_HD': 1920,
+    'FOUR_K': 2160,
+    'FIVE_K': 2880,
+    'SIX_K': 3384,
+    'EIGHT_K': 4320
+}
+
+
+def compare(value: Optional[int], criterion: Dict) -> bool:
+    # IntCriterionInput
+    modifier = criterion['modifier']
+
+    if modifier == 'IS_NULL':
+        return value is None
+
+    if modifier == 'NOT_NULL':
+        return value is not None
+
+    if value is None:
+        return False
+
+    return {
+        'EQUALS': lambda: value == criterion['value'],
+        'NOT_EQUALS': lambda: value != criterion['value'],
+        'GREATER_THAN': lambda: value > criterion['value'],
+        'LESS_THAN': lambda: value < criterion['value'],
+        'BETWEEN': lambda: criterion['value'] <= value <= criterion['value2'],
+        'NOT_BETWEEN': lambda: not criterion['value'] <= value <= criterion['value2']
+    }[modifier]()
+
+
+class Library:
+    # relations are drawn once from a seeded generator, entities are built on demand from their index
+
+    def __init__(self, scenes: int, fanout: Fanout = Fanout(), base_url: str = 'http://127.0.0.1:9999',
+                 seed: int = 0):
+        self.fanout = fanout
+        self.base_url = base_url
+
+        self.counts = {
+            'scenes': scenes,
+            'performers': max(scenes // 20, 10),
+            'tags': max(scenes // 50, 20),
+            'studios': max(scenes // 500, 5),
+            'movies': max(scenes // 100, 5),
+            'galleries': scenes * fanout.galleries_per_scene,
+            'scene_markers': scenes * fanout.markers_per_scene
+        }
+
+        generator = random.Random(seed)
+
+        def sample(kind: str, k: int) -> List[int]:
+            return generator.sample(range(self.counts[kind]), min(k, self.counts[kind]))
+
+        self.scene_performers = [sample('performers', fanout.performers_per_scene) for _ in range(scenes)]
+        self.scene_tags = [sample('tags', fanout.tags_per_scene) for _ in range(scenes)]
+        self.scene_studio = [generator.randrange(self.counts['studios']) for _ in range(scenes)]
+        self.scene_movie = [generator.randrange(self.counts['movies']) if generator.random() < 0.2 else None
+                            for _ in range(scenes)]
+
+        self.performer_scenes = defaultdict(list)
+        self.tag_scenes = defaultdict(list)
+        self.studio_scenes = defaultdict(list)
+        self.movie_scenes = defaultdict(list)
+
+        for scene in range(scenes):
+            for performer in self.scene_performers[scene]:
+                self.performer_scenes[performer].append(scene)
+
+            for tag in self.scene_tags[scene]:
+                self.tag_scenes[tag].append(scene)
+
+            self.studio_scenes[self.scene_studio[scene]].append(scene)
+
+            if self.scene_movie[scene] is not None:
+                self.movie_scenes[self.scene_movie[scene]].append(scene)
+
+        # kind -> (entity, {criterion: related ids of an entity}, text searched by q)
+        self.kinds = {
+            'scenes': (Scene, {
+                'performers': lambda i: self.scene_performers[i],
+                'tags': lambda i: self.scene_tags[i],
+                'studios': lambda i: [self.scene_studio[i]],
+                'movies': lambda i: [self.scene_movie[i]] if self.scene_movie[i] is not None else []
+            }, lambda e: e.title),
+            'galleries': (Gallery, {
+                'performers': lambda i: self.scene_performers[self.gallery_scene(i)],
+                'tags': lambda i: self.scene_tags[self.gallery_scene(i)],
+                'studios': lambda i: [self.scene_studio[self.gallery_scene(i)]]
+            }, lambda e: e.title or ''),
+            'performers': (Performer, {}, lambda e: e.name),
+            'tags': (Tag, {}, lambda e: e.name),
+            'studios': (Studio, {}, lambda e: e.name),
+            'movies': (Movie, {}, lambda e: e.name),
+            'scene_markers': (SceneMarker, {
+                'tags': lambda i: self.scene_tags[i // max(fanout.markers_per_scene, 1)],
+                'performers': lambda i: self.scene_performers[i // max(fanout.markers_per_scene, 1)]
+            }, lambda e: e.title)
+        }
+
+    def gallery_scene(self, gallery: int) -> int:
+        return gallery // self.fanout.galleries_per_scene
+
+    def url(self, path: str) -> str:
+        return f'{self.base_url}/{path}'
+
+    def entity(self, kind: str, entity_id) -> Optional[object]:
+        try:
+            index = int(entity_id)
+
+        except (TypeError, ValueError):
+            return None
+
+        if not 0 <= index < self.counts[kind]:
+            return None
+
+        return self.kinds[kind][0](self, index)
+
+    def find(self, kind: str, filter: Optional[Dict], criteria: Optional[Dict], ids: Optional[List] = None) -> Dict:
+        entity, relations, text = self.kinds[kind]
+        filter = filter or {}
+        criteria = criteria or {}
+
+        if ids is not None:
+            indexes = [int(i) for i in ids if 0 <= int(i) < self.counts[kind]]
+
+        else:
+            indexes = range(self.counts[kind])
+
+        predicates = self.predicates(kind, criteria, relations)
+        if len(predicates) > 0:
+            indexes = [i for i in indexes if all(p(i) for p in predicates)]
+
+        if filter.get('q'):
+            q = filter['q'].lower()
+            indexes = [i for i in indexes if q in text(entity(self, i)).lower()]
+
+        indexes = self.order(kind, list(indexes), filter.get('sort'), filter.get('direction'))
+
+        per_page = filter.get('per_page', DEFAULT_PER_PAGE)
+        page = max(filter.get('page') or 1, 1)
+
+        # per_page 0 (or less) returns everything
+        page_indexes = indexes if per_page <= 0 else indexes[(page - 1) * per_page:page * per_page]
+
+        return {'count': len(indexes), kind: [entity(self, i) for i in page_indexes]}
+
+    def predicates(self, kind: str, criteria: Dict, relations: Dict[str, Callable]) -> List[Callable[[int], bool]]:
+        entity = self.kinds[kind][0]
+        predicates = []
+
+        for name, criterion in criteria.items():
+            if criterion is None:
+                continue
+
+            if name in relations:
+                related = relations[name]
+                values = {int(v) for v in criterion['value'] or []}
+                modifier = criterion['modifier']
+
+                if modifier == 'INCLUDES_ALL':
+                    predicates.append(lambda i, related=related, values=values: values <= set(related(i)))
+
+                elif modifier == 'EXCLUDES':
+                    predicates.append(lambda i, related=related, values=values: not values & set(related(i)))
+
+                else:
+                    predicates.append(lambda i, related=related, values=values: bool(values & set(related(i))))
+
+            elif name == 'organized':
+                predicates.append(lambda i, organized=criterion: entity(self, i).organized == organized)
+
+            elif name in ('rating', 'o_counter', 'play_count'):
+                predicates.append(lambda i, name=name, criterion=criterion:
+                                  compare(getattr(entity(self, i), name), criterion))
+
+            elif name == 'duration':
+                predicates.append(lambda i, criterion=criterion:
+                                  compare(int(entity(self, i).file['duration']), criterion))
+
+            elif name == 'resolution':
+                height = RESOLUTIONS[criterion['value']]
+                predicates.append(lambda i, height=height, modifier=criterion['modifier']:
+                                  compare(min(entity(self, i).file['width'], entity(self, i).file['height']),
+                                          {'value': height, 'modifier': modifier}))
+
+            elif name == 'updated_at':
+                # every entity was last updated at UPDATED_AT
+                if criterion['modifier'] == 'GREATER_THAN':
+                    predicates.append(lambda i, since=criterion['value']: UPDATED_AT > since)
+
+        return predicates
+
+    def order(self, kind: str, indexes: List[int], sort: Optional[str], direction: Optional[str]) -> List[int]:
+        entity = self.kinds[kind][0]
+
+        if sort is None:
+            ordered = indexes
+
+        elif sort.startswith('random'):
+            # random_<seed> gives a stable order, like Stash
+            seed = sort.partition('_')[2]
+            ordered = list(indexes)
+            random.Random(int(seed) if seed.isdigit() else None).shuffle(ordered)
+
+        else:
+            ordered = sorted(indexes, key=lambda i: (getattr(entity(self, i), sort, None) is None,
+                                                     getattr(entity(self, i), sort, None) or 0))
+
+        return ordered[::-1] if direction == 'DESC' else ordered
+
+
+class Entity:
+    def __init__(self, library: Library, index: int):
+        self.library = library
+        self.index = index
+        self.id = str(index)
+        self.checksum = f'{type(self).__name__.lower()}{index:08x}'
+        self.created_at = CREATED_AT
+        self.updated_at = UPDATED_AT
+        self.rating = index % 6 or None
+        self.url = None
+        self.details = None
+
+
+class Scene(Entity):
+    def __init__(self, library: Library, index: int):
+        super().__init__(library, index)
+        self.oshash = self.checksum
+        self.title = f'Scene {index}'
+        self.details = ' '.join(['Lorem ipsum dolor sit amet, consectetur adipiscing elit.'] * (index % 7)) or None
+        self.date = f'20{10 + index % 12}-{1 + index % 12:02d}-{1 + index % 28:02d}'
+        self.organized = index % 5 != 0
+        self.o_counter = index % 4
+        self.play_count = index % 9
+        self.path = f'/library/scenes/{index}.mp4'
+        self.file = {
+            'size': str(500_000_000 + index),
+            'duration': 600.0 + index % 3000,
+            'video_codec': 'h264',
+            'audio_codec': 'aac',
+            'width': 1920,
+            'height': 1080,
+            'framerate': 29.97,
+            'bitrate': 8_000_000
+        }
+        self.paths = {
+            name: library.url(f'scene/{index}/{name}')
+            for name in ('screenshot', 'preview', 'stream', 'webp', 'vtt', 'chapters_vtt', 'sprite')
+        }
+
+    @property
+    def scene_markers(self):
+        per_scene = self.library.fanout.markers_per_scene
+        return [SceneMarker(self.library, self.index * per_scene + k) for k in range(per_scene)]
+
+    @property
+    def galleries(self):
+        per_scene = self.library.fanout.galleries_per_scene
+        return [Gallery(self.library, self.index * per_scene + k) for k in range(per_scene)]
+
+    @property
+    def studio(self):
+        return Studio(self.library, self.library.scene_studio[self.index])
+
+    @property
+    def movies(self):
+        movie = self.library.scene_movie[self.index]
+        return [{'movie': Movie(self.library, movie), 'scene_index': 1}] if movie is not None else []
+
+    @property
+    def tags(self):
+        return [Tag(self.library, t) for t in self.library.scene_tags[self.index]]
+
+    @property
+    def performers(self):
+        return [Performer(self.library, p) for p in self.library.scene_performers[self.index]]
+
+
+class SceneMarker(Entity):
+    def __init__(self, library: Library, index: int):
+        super().__init__(library, index)
+        self.scene_index = index // max(library.fanout.markers_per_scene, 1)
+        self.title = f'Marker {index}'
+        self.seconds = float(30 + index % 500)
+        self.stream = library.url(f'scene/{self.scene_index}/scene_marker/{index}/stream')
+        self.preview = library.url(f'scene/{self.scene_index}/scene_marker/{index}/preview')
+        self.screenshot = library.url(f'scene/{self.scene_index}/scene_marker/{index}/screenshot')
+
+    @property
+    def scene(self):
+        return Scene(self.library, self.scene_index)
+
+    @property
+    def primary_tag(self):
+        return Tag(self.library, self.library.scene_tags[self.scene_index][0])
+
+    @property
+    def tags(self):
+        return []
+
+
+class Image(Entity):
+    def __init__(self, library: Library, gallery: int, number: int):
+        super().__init__(library, gallery * library.fanout.images_per_gallery + number)
+        self.gallery_index = gallery
+        self.title = f'Image {number + 1}'
+        self.organized = True
+        self.o_counter = 0
+        self.path = f'/library/galleries/{gallery}/{number}.jpg'
+        # every third image is portrait
+        self.file = {'size': 2_000_000, 'width': 4000, 'height': 3000} if number % 3 else \
+            {'size': 2_000_000, 'width': 3000, 'height': 4000}
+        self.paths = {
+            'image': library.url(f'image/{self.index}/image'),
+            'thumbnail': library.url(f'image/{self.index}/thumbnail')
+        }
+
+    @property
+    def galleries(self):
+        return [Gallery(self.library, self.gallery_index)]
+
+    @property
+    def studio(self):
+        return Gallery(self.library, self.gallery_index).studio
+
+    @property
+    def tags(self):
+        return []
+
+    @property
+    def performers(self):
+        return []
+
+
+class Gallery(Entity):
+    def __init__(self, library: Library, index: int):
+        super().__init__(library, index)
+        self.scene_index = library.gallery_scene(index)
+        self.path = f'/library/galleries/{index}.zip'
+        # some galleries are untitled, like in most libraries
+        self.title = f'Gallery {index}' if index % 4 else None
+        self.date = f'20{10 + index % 12}-01-01'
+        self.organized = index % 5 != 0
+        self.image_count = library.fanout.images_per_gallery
+
+    @property
+    def scenes(self):
+        return [Scene(self.library, self.scene_index)]
+
+    @property
+    def studio(self):
+        return Studio(self.library, self.library.scene_studio[self.scene_index])
+
+    @property
+    def tags(self):
+        return [Tag(self.library, t) for t in self.library.scene_tags[self.scene_index]]
+
+    @property
+    def performers(self):
+        return [Performer(self.library, p) for p in self.library.scene_performers[self.scene_index]]
+
+    @property
+    def images(self):
+        return [Image(self.library, self.index, k) for k in range(self.image_count)]
+
+    @property
+    def cover(self):
+        return Image(self.library, self.index, 0) if self.image_count > 0 else None
+
+
+class Performer(Entity):
+    def __init__(self, library: Library, index: int):
+        super().__init__(library, index)
+        self.name = f'Performer {index}'
+        self.gender = 'FEMALE' if index % 3 else 'MALE'
+        self.birthdate = f'19{70 + index % 30}-01-01'
+        self.ethnicity = None
+        self.country = None
+        self.favorite = index % 10 == 0
+        self.image_path = library.url(f'performer/{index}/image')
+        self.scene_count = len(library.performer_scenes[index])
+        self.gallery_count = self.scene_count * library.fanout.galleries_per_scene
+        self.image_count = self.gallery_count * library.fanout.images_per_gallery
+
+    @property
+    def tags(self):
+        return []
+
+    @property
+    def scenes(self):
+        return [Scene(self.library, s) for s in self.library.performer_scenes[self.index]]
+
+
+class Studio(Entity):
+    def __init__(self, library: Library, index: int):
+        super().__init__(library, index)
+        self.name = f'Studio {index}'
+        self.image_path = library.url(f'studio/{index}/image')
+        self.scene_count = len(library.studio_scenes[index])
+        self.parent_studio = None
+        self.child_studios = []
+
+
+class Tag(Entity):
+    def __init__(self, library: Library, index: int):
+        super().__init__(library, index)
+        self.name = f'Tag {index}'
+        self.image_path = library.url(f'tag/{index}/image')
+        self.scene_count = len(library.tag_scenes[index])
+        self.scene_marker_count = self.scene_count * library.fanout.markers_per_scene
+        self.gallery_count = self.scene_count * library.fanout.galleries_per_scene
+        self.image_count = self.gallery_count * library.fanout.images_per_gallery
+        self.performer_count = 0
+
+
+class Movie(Entity):
+    def __init__(self, library: Library, index: int):
+        super().__init__(library, index)
+        self.name = f'Movie {index}'
+        self.aliases = None
+        self.duration = 5400
+        self.date = f'20{10 + index % 12}-01-01'
+        self.director = f'Director {index % 17}'
+        self.synopsis = 'Lorem ipsum dolor sit amet.'
+        self.front_image_path = library.url(f'movie/{index}/frontimage')
+        self.back_image_path = library.url(f'movie/{index}/backimage')
+        self.scene_count = len(library.movie_scenes[index])
+
+    @property
+    def studio(self):
+        return Studio(self.library, self.index % self.library.counts['studios'])
+
+
+class Query:
+    # root resolvers, graphql-core calls them with the field arguments
+
+    def __init__(self, library: Library):
+        self.library = library
+
+    def findScene(self, info, id=None):
+        return self.library.entity('scenes', id)
+
+    def findScenes(self, info, scene_filter=None, scene_ids=None, filter=None):
+        return self.library.find('scenes', filter, scene_filter, scene_ids)
+
+    def findSceneMarkers(self, info, scene_marker_filter=None, filter=None):
+        return self.library.find('scene_markers', filter, scene_marker_filter)
+
+    def findPerformer(self, info, id):
+        return self.library.entity('performers', id)
+
+    def findPerformers(self, info, performer_filter=None, filter=None):
+        return self.library.find('performers', filter, performer_filter)
+
+    def findStudio(self, info, id):
+        return self.library.entity('studios', id)
+
+    def findStudios(self, info, studio_filter=None, filter=None):
+        return self.library.find('studios', filter, studio_filter)
+
+    def findMovie(self, info, id):
+        return self.library.entity('movies', id)
+
+    def findMovies(self, info, movie_filter=None, filter=None):
+        return self.library.find('movies', filter, movie_filter)
+
+    def findGallery(self, info, id):
+        return self.library.entity('galleries', id)
+
+    def findGalleries(self, info, gallery_filter=None, filter=None):
+        return self.library.find('galleries', filter, gallery_filter)
+
+    def findTag(self, info, id):
+        return self.library.entity('tags', id)
+
+    def findTags(self, info, tag_filter=None, filter=None):
+        return self.library.find('tags', filter, tag_filter)
+
+
+def server(library: Library, port: int = 0, schema: GraphQLSchema = None) -> ThreadingHTTPServer:
+    schema = schema or build_schema(SCHEMA_PATH.read_text())
+    root = Query(library)
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+
+            result = graphql_sync(schema, request['query'], root_value=root,
+                                  variable_values=request.get('variables'),
+                                  operation_name=request.get('operationName'))
+
+            response = {'data': result.data}
+            if result.errors:
+                response['errors'] = [e.formatted for e in result.errors]
+
+            body = json.dumps(response).encode('utf-8')
+
+            # like Stash, validation errors get a 422
+            self.send_response(422 if result.data is None else 200)
+            self.send_header('Content-Type', 'application/json')
+
+            # Stash compresses its responses too
+            if 'gzip' in self.headers.get('Accept-Encoding', ''):
+                body = gzip.compress(body, compresslevel=5)
+                self.send_header('Content-Encoding', 'gzip')
+
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    httpd = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    library.base_url = f'http://127.0.0.1:{httpd.server_address[1]}'
+
+    return httpd
+
+
+def add_fanout_arguments(parser: argparse.ArgumentParser):
+    for name, default in Fanout._field_defaults.items():
+        parser.add_argument(f'--{name.replace("_", "-")}', type=int, default=default)
+
+
+def fanout(args: argparse.Namespace) -> Fanout:
+    return Fanout(**{name: getattr(args, name) for name in Fanout._fields})
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Mock Stash GraphQL server with a synthetic library')
+    parser.add_argument('--scenes', type=int, default=1000)
+    parser.add_argument('--port', type=int, default=9999)
+    parser.add_argument('--seed', type=int, default=0)
+    add_fanout_arguments(parser)
+    args = parser.parse_args()
+
+    library = Library(args.scenes, fanout(args), seed=args.seed)
+    httpd = server(library, args.port)
+
+    print(f'Serving {args.scenes} scenes on {library.base_url}/graphql', flush=True)
+    httpd.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
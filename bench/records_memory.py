@@ -0,0 +1,99 @@
+# Compares the memory a scene listing keeps alive: the decoded response dicts, versus the compact
+# records.Scene tuples the directory items are built from, for a synthetic findScenes response.
+#
+#   python bench/records_memory.py [--scenes N]
+
+import argparse
+import gc
+import json
+import random
+import sys
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from records import Scene
+
+STUDIOS = 200
+PERFORMERS = 2000
+TAGS = 500
+
+
+def synthetic_scene(i: int) -> dict:
+    # shaped like a ListScenes scene once its references are resolved (plugin.resolve_scenes)
+    studio = random.randrange(STUDIOS)
+
+    return {
+        'id': str(i),
+        'title': f'Scene {i}',
+        'details': ' '.join(['Lorem ipsum dolor sit amet.'] * random.randint(0, 12)),
+        'date': '2021-06-01',
+        'o_counter': random.randint(0, 5),
+        'paths': {
+            'screenshot': f'http://localhost:9999/scene/{i}/screenshot',
+            'stream': f'http://localhost:9999/scene/{i}/stream'
+        },
+        'studio': {
+            'name': f'Studio {studio}',
+            'image_path': f'http://localhost:9999/studio/{studio}/image'
+        },
+        'tags': [{'name': f'Tag {random.randrange(TAGS)}'} for _ in range(random.randint(0, 15))],
+        'performers': [
+            {'name': f'Performer {p}', 'image_path': f'http://localhost:9999/performer/{p}/image'}
+            for p in random.sample(range(PERFORMERS), random.randint(1, 4))
+        ],
+        'file': {
+            'duration': random.uniform(60, 3600),
+            'width': 1920,
+            'height': 1080,
+            'audio_codec': 'aac',
+            'video_codec': 'h264'
+        },
+        'galleries': [
+            {'id': str(g), 'cover': {'paths': {'image': f'http://localhost:9999/image/{g}/image'}}}
+            for g in range(random.randint(0, 2))
+        ]
+    }
+
+
+def retained(build) -> int:
+    # bytes still allocated once build's result is the only thing left
+    gc.collect()
+    tracemalloc.start()
+
+    result = build()
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+
+    tracemalloc.stop()
+
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Memory held by a scene listing, dicts versus records')
+    parser.add_argument('--scenes', type=int, default=50000)
+    args = parser.parse_args()
+
+    random.seed(0)
+    body = json.dumps({'data': {'allScenes': {
+        'count': args.scenes,
+        'scenes': [synthetic_scene(i) for i in range(args.scenes)]
+    }}})
+
+    print(f'{args.scenes} scenes, {len(body) / 1024 / 1024:.1f} MiB response body')
+
+    def dicts():
+        return json.loads(body)['data']['allScenes']['scenes']
+
+    def records():
+        return [Scene.decode(s) for s in json.loads(body)['data']['allScenes']['scenes']]
+
+    for name, build in [('dicts', dicts), ('records', records)]:
+        size = retained(build)
+        print(f'{name:>8}: {size / 1024 / 1024:7.1f} MiB retained, {size / args.scenes:6.0f} bytes per scene')
+
+
+if __name__ == '__main__':
+    main()
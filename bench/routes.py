@@ -0,0 +1,199 @@
+# Drives the plugin's routes against bench/mock_stash.py, each invocation in a fresh interpreter with the fake
+# Kodi modules in bench/kodi, like Kodi runs the addon for every click. Measures wall time (including the
+# interpreter start), peak RSS, the bytes transferred and the items rendered, using the plugin's own route
+# timings (instrumentation.py) for the breakdown.
+#
+#   python bench/routes.py [--scenes 1000,10000,100000] [--runs N] [--route list_scenes ...]
+#                          [--setting id=value ...] [--output results.json] [--baseline results.json]
+#
+# Linux only (peak RSS comes from /proc). Needs graphql-core (like build.py) and requests. Results written with
+# --output are keyed by library size and route, --baseline compares against such a file from another commit (same
+# arguments give the same library).
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List
+
+from mock_stash import Library, add_fanout_arguments, fanout, server
+
+ROOT = Path(__file__).resolve().parent.parent
+KODI_PATH = Path(__file__).resolve().parent / 'kodi'
+
+# route name -> (path, query string), ids are the first of each kind
+ROUTES = {
+    'list_scenes': ('/scenes', ''),
+    'scene_contents': ('/scenes/1', ''),
+    'list_performers': ('/performers', ''),
+    'performer_contents': ('/performers/1', ''),
+    'list_galleries': ('/galleries', ''),
+    'gallery_contents': ('/galleries/1', ''),
+    'list_tags': ('/tags', ''),
+    'tag_contents': ('/tags/1', ''),
+    'list_movies': ('/movies', ''),
+    'movie_contents': ('/movies/1', ''),
+    'search': ('/search', ''),
+    'scene_widget': ('/widgets/recent', ''),
+    'tag_widget': ('/widgets/tags/1', '')
+}
+
+# every run starts with an empty profile, so without a cache each run measures the full round trip
+DEFAULT_SETTINGS = {
+    'cache_enabled': 'false',
+    'performance_stats': 'true',
+    'performance_log_level': '0'
+}
+
+# runpy would replace sys.argv[0], which is the plugin URL in Kodi. The peak RSS is read from VmHWM, ru_maxrss
+# would include the benchmark's own (inherited at fork).
+RUNNER = """
+import os, re, sys
+sys.argv = sys.argv[1:]
+try:
+    exec(compile(open('plugin.py').read(), 'plugin.py', 'exec'), {'__name__': '__main__', '__file__': 'plugin.py'})
+finally:
+    with open('/proc/self/status') as status:
+        peak = re.search(r'VmHWM:\\s+(\\d+) kB', status.read()).group(1)
+    with open(os.path.join(os.environ['BENCH_PROFILE'], 'peak_rss'), 'w') as f:
+        f.write(peak)
+"""
+
+
+def run_route(url: str, route: str, path: str, query: str, settings: Dict[str, str]) -> Dict:
+    with tempfile.TemporaryDirectory() as profile:
+        env = {
+            **os.environ,
+            'PYTHONPATH': os.pathsep.join([str(KODI_PATH), str(ROOT)]),
+            'BENCH_PROFILE': profile,
+            'BENCH_SETTINGS': json.dumps({'url': url, **settings})
+        }
+
+        started = time.perf_counter()
+        process = subprocess.Popen([sys.executable, '-c', RUNNER, f'plugin://plugin.video.stashapp{path}', '1',
+                                    query], cwd=ROOT, env=env, stderr=subprocess.PIPE)
+
+        stderr = process.stderr.read()
+        status = process.wait()
+        wall = time.perf_counter() - started
+
+        if status != 0:
+            raise RuntimeError(f'{route} failed:\n{stderr.decode("utf-8", "replace")}')
+
+        stats = [json.loads(line) for line in (Path(profile) / 'stats.jsonl').read_text().splitlines()]
+        peak_rss = int((Path(profile) / 'peak_rss').read_text()) * 1024
+
+    record = next(r for r in stats if r['route'] == route)
+
+    return {
+        'wall': wall,
+        'total': record['total'],
+        'spans': record['spans'],
+        'peak_rss': peak_rss,
+        'transferred': record['counts'].get('transferred', 0),
+        'decoded': record['counts'].get('decoded', 0),
+        'requests': record['counts'].get('requests', 0),
+        'items': record['counts'].get('items', 0)
+    }
+
+
+def median_run(runs: List[Dict]) -> Dict:
+    return {
+        'wall': statistics.median(r['wall'] for r in runs),
+        'total': statistics.median(r['total'] for r in runs),
+        'spans': {name: statistics.median(r['spans'].get(name, 0.0) for r in runs)
+                  for name in sorted({name for r in runs for name in r['spans']})},
+        'peak_rss': max(r['peak_rss'] for r in runs),
+        # the same for every run
+        **{name: runs[-1][name] for name in ('transferred', 'decoded', 'requests', 'items')}
+    }
+
+
+def change(value: float, baseline: float) -> str:
+    if not baseline:
+        return ''
+
+    return f' ({(value - baseline) / baseline * 100:+.0f}%)'
+
+
+def print_results(results: Dict[str, Dict[str, Dict]], baseline: Dict[str, Dict[str, Dict]]):
+    for size, routes in results.items():
+        print(f'\n{size} scenes')
+        print(f'{"route":<20} {"wall":>16} {"in plugin":>10} {"transferred":>20} {"decoded":>12} '
+              f'{"peak RSS":>12} {"items":>6}')
+
+        for route, result in routes.items():
+            before = baseline.get(size, {}).get(route, {})
+
+            print(f'{route:<20} '
+                  f'{result["wall"] * 1000:7.0f}ms{change(result["wall"], before.get("wall")):>7} '
+                  f'{result["total"] * 1000:8.0f}ms '
+                  f'{result["transferred"]:>11}{change(result["transferred"], before.get("transferred")):>9} '
+                  f'{result["decoded"]:>12} '
+                  f'{result["peak_rss"] / 1024 / 1024:9.1f}MiB '
+                  f'{result["items"]:>6}')
+
+
+def git_commit() -> str:
+    result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True)
+    return result.stdout.strip() or 'unknown'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the plugin routes against a mock Stash')
+    parser.add_argument('--scenes', default='1000,10000,100000', help='library sizes, comma separated')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--route', action='append', choices=ROUTES, help='routes to run (default: all)')
+    parser.add_argument('--setting', action='append', default=[], metavar='ID=VALUE',
+                        help='addon setting, e.g. page_size=500 or cache_enabled=true')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=Path)
+    parser.add_argument('--baseline', type=Path)
+    add_fanout_arguments(parser)
+    args = parser.parse_args()
+
+    settings = {**DEFAULT_SETTINGS, **dict(s.split('=', 1) for s in args.setting)}
+    routes = args.route or list(ROUTES)
+    baseline = json.loads(args.baseline.read_text())['results'] if args.baseline else {}
+
+    results = {}
+
+    for size in [int(s) for s in args.scenes.split(',')]:
+        started = time.perf_counter()
+        library = Library(size, fanout(args), seed=args.seed)
+        httpd = server(library)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+
+        print(f'{size} scenes generated in {time.perf_counter() - started:.1f}s', file=sys.stderr)
+
+        results[str(size)] = {}
+
+        for route in routes:
+            path, query = ROUTES[route]
+            runs = [run_route(library.base_url, route, path, query, settings) for _ in range(args.runs)]
+            results[str(size)][route] = median_run(runs)
+
+        httpd.shutdown()
+        httpd.server_close()
+
+    print_results(results, baseline)
+
+    if args.output is not None:
+        args.output.write_text(json.dumps({
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'arguments': {**{k: str(v) for k, v in vars(args).items() if k not in ('output', 'baseline')},
+                          'settings': settings},
+            'results': results
+        }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
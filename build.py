@@ -1,6 +1,8 @@
 
 import argparse
 import io
+import json
+import os
 import shutil
 import sys
 import tarfile
@@ -10,8 +12,11 @@ from tqdm import tqdm
 from io import BytesIO
 
 import requests
+from graphql import build_schema, parse, validate
 from pathlib import Path, PurePath
 
+import queries
+
 
 #parser = argparse.ArgumentParser(description='Build kodi-stash-addon')
 # parser.add_argument('target', )
@@ -36,11 +41,8 @@ class DependencySourceFile(typing.NamedTuple):
     stream: io.BufferedReader
 
 
+# nothing is vendored at the moment, GraphQL requests go through stash_client.py
 DEPENDENCIES = map(lambda a: Dependency(*a), [
-    ('gql', '2.0.0', 'gql'),
-    ('graphql-core', '2.3.2', 'graphql'),
-    ('promise', '2.3', 'promise'),
-    ('Rx', '3.1.1', 'rx')
 ])
 
 def pypi_dependency_files(dependency: Dependency):
@@ -71,9 +73,37 @@ def pypi_dependency_files(dependency: Dependency):
                 )
 
 
+# the snapshot of the targeted Stash release's schema, or the release's full schema (e.g. exported by introspection)
+SCHEMA_PATH = Path(os.environ.get('STASH_SCHEMA', 'schema/stash.graphql'))
+
+
+def compiled_queries() -> typing.Dict[str, str]:
+    schema = build_schema(SCHEMA_PATH.read_text())
+    compiled = queries.compile_queries()
+
+    errors = [
+        f'{name}: {error.message}'
+        for name, document in compiled.items()
+        for error in validate(schema, parse(document))
+    ]
+
+    if len(errors) > 0:
+        raise Exception('Invalid GraphQL queries:\n' + '\n'.join(errors))
+
+    return compiled
+
+
 ARCHIVE_CONTENTS = [
     'addon.xml',
     'plugin.py',
+    'cache.py',
+    'service.py',
+    'stash_client.py',
+    'queries.py',
+    'mirror.py',
+    'thumbnails.py',
+    'records.py',
+    'instrumentation.py',
     'resources/*'
 ]
 
@@ -88,6 +118,9 @@ with zipfile.ZipFile('plugin.video.stashapp.zip', 'w') as archive:
         for file in tqdm(files, unit=' files', desc=pattern):
             archive.write(file, arcname=str(root / file))
 
+    print('compiling queries...', file=sys.stderr)
+    archive.writestr(str(root / queries.COMPILED_PATH.name), json.dumps(compiled_queries()))
+
     print('adding dependencies...', file=sys.stderr)
 
     for dep in DEPENDENCIES:
@@ -0,0 +1,231 @@
+import hashlib
+import json
+import re
+import sqlite3
+import time
+import uuid
+from datetime import timedelta
+from pathlib import Path
+from typing import Any, Dict, List, NamedTuple, Optional
+
+
+# SQLite limits the number of parameters in a statement
+ENTITY_LOOKUP_BATCH = 500
+
+# how often an invocation waiting on another's identical request checks whether it has finished
+INFLIGHT_POLL_INTERVAL = 0.05  # seconds
+
+
+def normalize_document(document: str) -> str:
+    # whitespace and commas are insignificant in GraphQL documents
+    return re.sub(r'[\s,]+', ' ', document).strip()
+
+
+def cache_key(document: str, variables: Optional[Dict] = None) -> str:
+    key = normalize_document(document) + '\n' + json.dumps(variables or {}, sort_keys=True)
+
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+class CacheEntry(NamedTuple):
+    value: Any
+    stored_at: float
+    expires_at: float
+
+    @property
+    def fresh(self) -> bool:
+        return self.expires_at > time.time()
+
+
+class ResponseCache:
+    def __init__(self, path: Path, max_size: int, server: str):
+        # server is the Stash GraphQL URL, responses, entities and fanart picks all belong to it
+        self.path = path
+        self.max_size = max_size
+
+        # Kodi runs plugin invocations as interpreters within its own process, so they can't go by pid
+        self.owner = uuid.uuid4().hex
+
+        self.db = sqlite3.connect(str(path), timeout=10)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                stored_at REAL NOT NULL,
+                expires_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+        """)
+        self.db.execute('CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)')
+        # fanart picked for an entity, kept until the period (e.g. the day) changes
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS fanart (
+                key TEXT PRIMARY KEY,
+                period TEXT NOT NULL,
+                url TEXT NOT NULL
+            )
+        """)
+        # performers, tags and studios by id, shared by every response that references them
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS entities (
+                kind TEXT NOT NULL,
+                id TEXT NOT NULL,
+                value TEXT NOT NULL,
+                expires_at REAL NOT NULL,
+                PRIMARY KEY (kind, id)
+            )
+        """)
+        # requests being sent to Stash by some plugin invocation, see claim()
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS inflight (
+                key TEXT PRIMARY KEY,
+                owner TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            )
+        """)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS settings (
+                name TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            )
+        """)
+        self.db.commit()
+
+        # ids and responses of another Stash server mean nothing on this one, so switching servers starts over
+        row = self.db.execute("SELECT value FROM settings WHERE name = 'server'").fetchone()
+        if row is None or row[0] != server:
+            self.clear()
+
+            with self.db:
+                self.db.execute("INSERT OR REPLACE INTO settings VALUES ('server', ?)", (server,))
+
+    @staticmethod
+    def key(document: str, variables: Optional[Dict] = None) -> str:
+        return cache_key(document, variables)
+
+    def get(self, key: str) -> Optional[CacheEntry]:
+        # expired entries are still returned (check CacheEntry.fresh), for revalidation and offline use
+        row = self.db.execute('SELECT value, stored_at, expires_at FROM responses WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+
+        with self.db:
+            self.db.execute('UPDATE responses SET accessed_at = ? WHERE key = ?', (time.time(), key))
+
+        value, stored_at, expires_at = row
+
+        return CacheEntry(json.loads(value), stored_at, expires_at)
+
+    def put(self, key: str, value: Any, ttl: timedelta):
+        now = time.time()
+        data = json.dumps(value, separators=(',', ':'))
+
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)',
+                            (key, data, len(data), now, now + ttl.total_seconds(), now))
+
+        self.evict()
+
+    def size(self) -> int:
+        return self.db.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def evict(self):
+        # least recently used entries go first until the cache fits again
+        overflow = self.size() - self.max_size
+        if overflow <= 0:
+            return
+
+        evicted = []
+        for key, size in self.db.execute('SELECT key, size FROM responses ORDER BY accessed_at'):
+            if overflow <= 0:
+                break
+
+            evicted.append((key,))
+            overflow -= size
+
+        with self.db:
+            self.db.executemany('DELETE FROM responses WHERE key = ?', evicted)
+
+    def fanart(self, key: str, period: str) -> Optional[str]:
+        row = self.db.execute('SELECT url FROM fanart WHERE key = ? AND period = ?', (key, period)).fetchone()
+
+        return row[0] if row is not None else None
+
+    def remember_fanart(self, choices: Dict[str, str], period: str):
+        with self.db:
+            self.db.execute('DELETE FROM fanart WHERE period != ?', (period,))
+            self.db.executemany('INSERT OR REPLACE INTO fanart VALUES (?, ?, ?)',
+                                [(key, period, url) for key, url in choices.items()])
+
+    def entities(self, kind: str, ids: List[str], expired: bool = False) -> Dict[str, Dict]:
+        # only fresh entities unless expired, expired ones are fetched again and only used when Stash is unreachable
+        found = {}
+        expires_after = 0 if expired else time.time()
+
+        for i in range(0, len(ids), ENTITY_LOOKUP_BATCH):
+            batch = ids[i:i + ENTITY_LOOKUP_BATCH]
+            rows = self.db.execute(
+                f'SELECT id, value FROM entities WHERE kind = ? AND expires_at > ? '
+                f'AND id IN ({", ".join("?" * len(batch))})',
+                (kind, expires_after, *batch)
+            )
+
+            found.update((entity_id, json.loads(value)) for entity_id, value in rows)
+
+        return found
+
+    def put_entities(self, kind: str, entities: List[Dict], ttl: timedelta):
+        now = time.time()
+
+        # expired rows stay until they're replaced, for offline use (there are only as many as Stash has entities)
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO entities VALUES (?, ?, ?, ?)', [
+                (kind, e['id'], json.dumps(e, separators=(',', ':')), now + ttl.total_seconds())
+                for e in entities
+            ])
+
+    def claim(self, key: str, timeout: timedelta) -> bool:
+        # Single flight across plugin invocations (widgets refreshing while the user navigates): only the invocation
+        # holding the claim sends the request, the others wait() for the response it stores. A claim left behind by
+        # a crashed invocation lapses after the timeout.
+        now = time.time()
+
+        with self.db:
+            self.db.execute('DELETE FROM inflight WHERE key = ? AND expires_at <= ?', (key, now))
+            inserted = self.db.execute('INSERT OR IGNORE INTO inflight VALUES (?, ?, ?)',
+                                       (key, self.owner, now + timeout.total_seconds()))
+
+        return inserted.rowcount == 1
+
+    def release(self, key: str):
+        with self.db:
+            self.db.execute('DELETE FROM inflight WHERE key = ? AND owner = ?', (key, self.owner))
+
+    def wait(self, key: str, timeout: Optional[timedelta] = None) -> Optional[CacheEntry]:
+        # the response stored by the invocation holding the claim, None if it failed, its claim lapsed or it took
+        # longer than the timeout
+        deadline = time.time() + timeout.total_seconds() if timeout is not None else None
+
+        while True:
+            row = self.db.execute('SELECT expires_at FROM inflight WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                break
+
+            if row[0] <= time.time() or deadline is not None and deadline <= time.time():
+                return None
+
+            time.sleep(INFLIGHT_POLL_INTERVAL)
+
+        entry = self.get(key)
+
+        return entry if entry is not None and entry.fresh else None
+
+    def clear(self):
+        with self.db:
+            self.db.execute('DELETE FROM responses')
+            self.db.execute('DELETE FROM fanart')
+            self.db.execute('DELETE FROM entities')
+
+        self.db.execute('VACUUM')
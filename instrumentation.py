@@ -0,0 +1,152 @@
+import json
+import math
+import sys
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, List, Tuple
+
+# Per route timings: how long a directory spent in each span, and what it moved. The spans are:
+#
+#   import   module setup before the route ran (imports, settings, opening the cache)
+#   query    looking up the query documents
+#   cache    response cache lookups and writes
+#   wait     waiting for another plugin invocation's identical request (see ResponseCache.claim)
+#   request  waiting for Stash, summed over concurrent requests
+#   decode   decoding JSON responses
+#   build    building the ListItems, from the first item until the directory is handed to Kodi
+#   render   addDirectoryItems and endOfDirectory
+#
+# Streamed listings build items while the response arrives, so request and decode overlap build there.
+
+SPANS = ['import', 'query', 'cache', 'wait', 'request', 'decode', 'build', 'render']
+
+# the stats file is rolled over (keeping one previous file) once it grows past this
+STATS_MAX_SIZE = 1024 * 1024
+
+
+class Trace:
+    def __init__(self, route: str):
+        self.route = route
+        self.started = time.perf_counter()
+        self.spans = defaultdict(float)  # seconds
+        self.counts = defaultdict(int)
+
+    @contextmanager
+    def span(self, name: str) -> Iterator[None]:
+        started = time.perf_counter()
+
+        try:
+            yield
+
+        finally:
+            self.add(name, time.perf_counter() - started)
+
+    def add(self, name: str, seconds: float):
+        self.spans[name] += seconds
+
+    def count(self, name: str, amount: int = 1):
+        self.counts[name] += amount
+
+    def finish(self) -> Dict:
+        return {
+            'route': self.route,
+            'at': time.time(),
+            'total': time.perf_counter() - self.started + self.spans['import'],
+            'spans': dict(self.spans),
+            'counts': dict(self.counts)
+        }
+
+
+def describe(record: Dict) -> str:
+    spans = ', '.join(f'{name} {record["spans"][name] * 1000:.0f}ms' for name in SPANS if name in record['spans'])
+    counts = ', '.join(f'{value} {name}' for name, value in record['counts'].items())
+
+    return f'{record["route"]}: {record["total"] * 1000:.0f}ms ({spans}), {counts}'
+
+
+def append_stats(path: Path, record: Dict):
+    try:
+        if path.stat().st_size > STATS_MAX_SIZE:
+            path.replace(path.with_suffix(path.suffix + '.1'))
+
+    except FileNotFoundError:
+        pass
+
+    # a single short append, concurrent plugin invocations don't interleave within a line
+    with path.open('a', encoding='utf-8') as f:
+        f.write(json.dumps(record, separators=(',', ':')) + '\n')
+
+
+def load_stats(path: Path) -> List[Dict]:
+    records = []
+
+    for file in [path.with_suffix(path.suffix + '.1'), path]:
+        try:
+            lines = file.read_text(encoding='utf-8').splitlines()
+
+        except FileNotFoundError:
+            continue
+
+        for line in lines:
+            try:
+                records.append(json.loads(line))
+
+            except ValueError:
+                continue  # cut short by a crash
+
+    return records
+
+
+def percentile(values: List[float], p: float) -> float:
+    # nearest rank
+    ordered = sorted(values)
+
+    return ordered[max(math.ceil(p / 100 * len(ordered)) - 1, 0)] if ordered else 0.0
+
+
+def summarize(records: List[Dict]) -> Dict[str, Dict[str, Tuple[float, float]]]:
+    # route -> metric (total, the spans, the counts) -> (p50, p95)
+    metrics = defaultdict(lambda: defaultdict(list))
+    counts = sorted({name for record in records for name in record['counts']})
+
+    for record in records:
+        route = metrics[record['route']]
+
+        route['total'].append(record['total'])
+        for name in SPANS:
+            route[name].append(record['spans'].get(name, 0.0))
+
+        # counts a run didn't have (e.g. no requests when cached) are zero
+        for name in counts:
+            route[name].append(record['counts'].get(name, 0))
+
+    return {
+        route: {name: (percentile(values, 50), percentile(values, 95)) for name, values in route_metrics.items()}
+        for route, route_metrics in metrics.items()
+    }
+
+
+def report(records: List[Dict]) -> str:
+    lines = []
+    runs = defaultdict(int)
+    for record in records:
+        runs[record['route']] += 1
+
+    for route, metrics in sorted(summarize(records).items()):
+        lines.append(f'{route} ({runs[route]} runs)')
+
+        for name, (p50, p95) in metrics.items():
+            if name == 'total' or name in SPANS:
+                lines.append(f'    {name:<12} p50 {p50 * 1000:8.0f}ms   p95 {p95 * 1000:8.0f}ms')
+
+            else:
+                lines.append(f'    {name:<12} p50 {p50:10.0f}   p95 {p95:10.0f}')
+
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    # python instrumentation.py <profile>/stats.jsonl
+    print(report(load_stats(Path(sys.argv[1]))))
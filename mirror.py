@@ -0,0 +1,361 @@
+import json
+import re
+import sqlite3
+import zlib
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+from queries import document
+
+# takes a GraphQL document and its variables, returns the response data
+QueryFunction = Callable[[str, Dict], Dict]
+
+SYNC_PAGE_SIZE = 500
+
+# updated_at of an entity that has never been synced
+EPOCH = '1970-01-01T00:00:00Z'
+
+
+class MirroredKind(NamedTuple):
+    name: str
+    # suffix of the Mirror<operation> and Mirror<operation>Ids documents in queries.py
+    operation: str
+    label_field: str
+    # related kind -> function returning the related ids of an entity
+    relations: Dict[str, Callable[[Dict], List[str]]]
+
+
+def ids(entities: List[Dict]) -> List[str]:
+    return [e['id'] for e in entities]
+
+
+MIRRORED_KINDS = [
+    MirroredKind('scenes', 'Scenes', 'title', {
+        'studios': lambda s: [s['studio']['id']] if s['studio'] else [],
+        'performers': lambda s: ids(s['performers']),
+        'tags': lambda s: ids(s['tags']),
+        'movies': lambda s: [m['movie']['id'] for m in s['movies']]
+    }),
+
+    MirroredKind('galleries', 'Galleries', 'title', {
+        'performers': lambda g: ids(g['performers']),
+        'tags': lambda g: ids(g['tags'])
+    }),
+
+    MirroredKind('performers', 'Performers', 'name', {}),
+    MirroredKind('tags', 'Tags', 'name', {}),
+    MirroredKind('movies', 'Movies', 'name', {}),
+    MirroredKind('studios', 'Studios', 'name', {}),
+]
+
+
+def join_text(*parts) -> str:
+    return ' '.join(filter(None, parts))
+
+
+# kind -> function returning the (title, body) full-text document of an entity
+SEARCH_DOCUMENTS = {
+    'scenes': lambda s: (s['title'], join_text(
+        s['details'],
+        s['studio']['name'] if s['studio'] else None,
+        *[p['name'] for p in s['performers']],
+        *[t['name'] for t in s['tags']]
+    )),
+    'galleries': lambda g: (g['title'], join_text(g['studio']['name'] if g['studio'] else None)),
+    'performers': lambda p: (p['name'], ''),
+    'tags': lambda t: (t['name'], ''),
+}
+
+# title matches count for more than matches in the rest of the document
+SEARCH_RANK = 'bm25(search, 10.0, 1.0)'
+
+# Stash sort keys the mirror can order by, and the column they map to
+SORT_COLUMNS = {
+    None: 'label COLLATE NOCASE',
+    'title': 'label COLLATE NOCASE',
+    'name': 'label COLLATE NOCASE',
+    'date': 'date',
+    'updated_at': 'updated_at',
+    'random': 'random()'
+}
+
+
+def second_before(timestamp: str) -> str:
+    # Stash's updated_at criteria only compare with GREATER_THAN, and its timestamps have a resolution of seconds
+    moment = datetime.fromisoformat(re.sub(r'\.\d+', '', timestamp).replace('Z', '+00:00'))
+
+    return (moment - timedelta(seconds=1)).isoformat()
+
+
+def shuffle_key(rowid: int, seed: int) -> int:
+    return zlib.crc32(f'{seed}:{rowid}'.encode('ascii'))
+
+
+def sort_column(sort: Optional[str]) -> Optional[str]:
+    # random_<seed> is a shuffle that stays the same from page to page, like in Stash
+    seeded = re.fullmatch(r'random_(\d+)', sort or '')
+    if seeded is not None:
+        return f'shuffle(e.rowid, {int(seeded.group(1))})'
+
+    return SORT_COLUMNS.get(sort)
+
+
+class LibraryMirror:
+    def __init__(self, path: Path):
+        self.db = sqlite3.connect(str(path), timeout=10)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.create_function('shuffle', 2, shuffle_key)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS entities (
+                kind TEXT NOT NULL,
+                id TEXT NOT NULL,
+                updated_at TEXT NOT NULL,
+                label TEXT,
+                date TEXT,
+                organized INTEGER,
+                data TEXT NOT NULL,
+                PRIMARY KEY (kind, id)
+            );
+            CREATE INDEX IF NOT EXISTS entities_label ON entities (kind, label COLLATE NOCASE);
+            CREATE INDEX IF NOT EXISTS entities_date ON entities (kind, date);
+
+            CREATE TABLE IF NOT EXISTS relations (
+                kind TEXT NOT NULL,
+                id TEXT NOT NULL,
+                related_kind TEXT NOT NULL,
+                related_id TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS relations_entity ON relations (kind, id);
+            CREATE INDEX IF NOT EXISTS relations_related ON relations (related_kind, related_id, kind);
+
+            CREATE TABLE IF NOT EXISTS sync_state (
+                kind TEXT PRIMARY KEY,
+                updated_at TEXT NOT NULL,
+                complete INTEGER NOT NULL
+            );
+        """)
+        self.db.commit()
+
+        self.searchable = self.create_search_index()
+
+    def create_search_index(self) -> bool:
+        exists = self.db.execute("SELECT 1 FROM sqlite_master WHERE name = 'search'").fetchone() is not None
+        if exists:
+            return True
+
+        try:
+            # rows share their rowid with the entities row they index
+            self.db.execute("""
+                CREATE VIRTUAL TABLE search USING fts5(
+                    title,
+                    body,
+                    tokenize = 'unicode61 remove_diacritics 2',
+                    prefix = '2 3'
+                )
+            """)
+
+        except sqlite3.OperationalError:
+            # SQLite built without FTS5
+            return False
+
+        # index whatever was mirrored before the index existed
+        with self.db:
+            for rowid, kind, data in self.db.execute('SELECT rowid, kind, data FROM entities').fetchall():
+                self.index(rowid, kind, json.loads(data))
+
+        return True
+
+    def index(self, rowid: int, kind: str, entity: Dict):
+        search_document = SEARCH_DOCUMENTS.get(kind)
+        if search_document is None:
+            return
+
+        title, body = search_document(entity)
+        self.db.execute('INSERT INTO search (rowid, title, body) VALUES (?, ?, ?)', (rowid, title or '', body))
+
+    def unindex(self, kind: str, entity_id: str):
+        if not self.searchable:
+            return
+
+        row = self.db.execute('SELECT rowid FROM entities WHERE kind = ? AND id = ?', (kind, entity_id)).fetchone()
+        if row is not None:
+            self.db.execute('DELETE FROM search WHERE rowid = ?', row)
+
+    def synced(self, kind: str) -> bool:
+        # true once the first full sync of a kind has finished
+        return self.db.execute('SELECT 1 FROM sync_state WHERE kind = ? AND complete', (kind,)).fetchone() is not None
+
+    def sync(self, query: QueryFunction, should_stop: Callable[[], bool] = lambda: False):
+        for kind in MIRRORED_KINDS:
+            if should_stop():
+                return
+
+            self.sync_kind(kind, query, should_stop)
+
+    def sync_kind(self, kind: MirroredKind, query: QueryFunction, should_stop: Callable[[], bool]):
+        row = self.db.execute('SELECT updated_at, complete FROM sync_state WHERE kind = ?', (kind.name,)).fetchone()
+        since, complete = row if row is not None else (EPOCH, False)
+
+        synced = self.sync_changes(kind, query, should_stop, since, complete)
+        if synced is None:
+            return
+
+        latest, total = synced
+
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO sync_state VALUES (?, ?, 1)', (kind.name, latest))
+
+        # changes only add and update rows: entities deleted upstream, or missed by an earlier sync, are found by id
+        if self.count(kind.name) != total:
+            self.reconcile(kind, query, should_stop)
+
+    def sync_changes(self, kind: MirroredKind, query: QueryFunction, should_stop: Callable[[], bool], since: str,
+                     complete: bool) -> Optional[Tuple[str, int]]:
+        # Stores the entities updated at or after since, oldest first so an interrupted sync resumes where it stopped.
+        # Returns the updated_at synced up to and the number of entities in Stash, None if stopped.
+        #
+        # Every page starts at the updated_at the previous one ended with, instead of at an offset: an entity updated
+        # meanwhile moves to the end, and would shift the entity at the page boundary out of reach of the next page.
+        # Entities with that updated_at are fetched again, only more than a page of them is paged through by offset.
+        cursor = since
+        page = 1
+
+        while True:
+            if should_stop():
+                return None
+
+            result = query(document(f'Mirror{kind.operation}'), {
+                'since': second_before(cursor),
+                'filter': {
+                    'page': page,
+                    'per_page': SYNC_PAGE_SIZE,
+                    'sort': 'updated_at',
+                    'direction': 'ASC'
+                }
+            })
+
+            entities = result['changed'][kind.name]
+
+            with self.db:
+                for entity in entities:
+                    self.store(kind, entity)
+
+                if len(entities) > 0 and entities[-1]['updated_at'] > cursor:
+                    cursor = entities[-1]['updated_at']
+                    page = 1
+
+                else:
+                    page += 1
+
+                self.db.execute('INSERT OR REPLACE INTO sync_state VALUES (?, ?, ?)', (kind.name, cursor, complete))
+
+            if len(entities) < SYNC_PAGE_SIZE:
+                return cursor, result['total']['count']
+
+    def store(self, kind: MirroredKind, entity: Dict):
+        # replacing the entities row gives it a new rowid, so the old index row goes first
+        self.unindex(kind.name, entity['id'])
+
+        cursor = self.db.execute('INSERT OR REPLACE INTO entities VALUES (?, ?, ?, ?, ?, ?, ?)', (
+            kind.name,
+            entity['id'],
+            entity['updated_at'],
+            entity.get(kind.label_field),
+            entity.get('date'),
+            entity.get('organized'),
+            json.dumps(entity, separators=(',', ':'))
+        ))
+
+        if self.searchable:
+            self.index(cursor.lastrowid, kind.name, entity)
+
+        self.db.execute('DELETE FROM relations WHERE kind = ? AND id = ?', (kind.name, entity['id']))
+        self.db.executemany('INSERT INTO relations VALUES (?, ?, ?, ?)', [
+            (kind.name, entity['id'], related_kind, related_id)
+            for related_kind, related_ids in kind.relations.items()
+            for related_id in related_ids(entity)
+        ])
+
+    def reconcile(self, kind: MirroredKind, query: QueryFunction, should_stop: Callable[[], bool]):
+        entities = query(document(f'Mirror{kind.operation}Ids'), {})['all'][kind.name]
+
+        remote = {e['id']: e['updated_at'] for e in entities}
+        local_ids = {row[0] for row in self.db.execute('SELECT id FROM entities WHERE kind = ?', (kind.name,))}
+
+        deleted = [(kind.name, entity_id) for entity_id in local_ids - remote.keys()]
+
+        with self.db:
+            for entity_kind, entity_id in deleted:
+                self.unindex(entity_kind, entity_id)
+
+            self.db.executemany('DELETE FROM entities WHERE kind = ? AND id = ?', deleted)
+            self.db.executemany('DELETE FROM relations WHERE kind = ? AND id = ?', deleted)
+
+        # the changes since the oldest missing entity are synced again
+        missing = remote.keys() - local_ids
+        if len(missing) > 0:
+            self.sync_changes(kind, query, should_stop, min(remote[entity_id] for entity_id in missing), True)
+
+    def count(self, kind: str) -> int:
+        return self.db.execute('SELECT COUNT(*) FROM entities WHERE kind = ?', (kind,)).fetchone()[0]
+
+    def get(self, kind: str, entity_id: str) -> Optional[Dict]:
+        if not self.synced(kind):
+            return None
+
+        row = self.db.execute('SELECT data FROM entities WHERE kind = ? AND id = ?', (kind, entity_id)).fetchone()
+
+        return json.loads(row[0]) if row is not None else None
+
+    def find(self, kind: str, page: int = 1, per_page: int = 0, sort: str = None, direction: str = None,
+             organized: bool = None, related: Tuple[str, str] = None) -> Optional[Tuple[int, List[Dict]]]:
+        # None means the mirror can't answer this, and Stash should be asked instead
+        column = sort_column(sort)
+        if not self.synced(kind) or column is None:
+            return None
+
+        where = ['e.kind = ?']
+        params = [kind]
+
+        if organized:
+            where.append('e.organized = 1')
+
+        if related is not None:
+            where.append('e.id IN (SELECT id FROM relations WHERE related_kind = ? AND related_id = ? AND kind = ?)')
+            params.extend([*related, kind])
+
+        where = ' AND '.join(where)
+
+        count = self.db.execute(f'SELECT COUNT(*) FROM entities e WHERE {where}', params).fetchone()[0]
+
+        order = f'{column} {"DESC" if direction == "DESC" else "ASC"}, e.id'
+        limit = ''
+        if per_page > 0:
+            limit = 'LIMIT ? OFFSET ?'
+            params.extend([per_page, (page - 1) * per_page])
+
+        rows = self.db.execute(f'SELECT e.data FROM entities e WHERE {where} ORDER BY {order} {limit}', params)
+
+        return count, [json.loads(row[0]) for row in rows]
+
+    def search(self, text: str, limit: int) -> Optional[List[Tuple[str, Dict]]]:
+        # ranked (kind, entity) matches, None if the mirror can't search
+        if not self.searchable or not all(self.synced(kind) for kind in SEARCH_DOCUMENTS):
+            return None
+
+        # every word has to match, the last one may still be incomplete
+        terms = re.findall(r'\w+', text)
+        if len(terms) == 0:
+            return []
+
+        match = ' '.join(f'"{term}"*' for term in terms)
+
+        rows = self.db.execute(f"""
+            SELECT e.kind, e.data FROM search s
+            JOIN entities e ON e.rowid = s.rowid
+            WHERE search MATCH ?
+            ORDER BY {SEARCH_RANK}
+            LIMIT ?
+        """, (match, limit))
+
+        return [(kind, json.loads(data)) for kind, data in rows]
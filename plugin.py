@@ -1,135 +1,546 @@
 
-import random
+import time
+
+# module setup is timed from here, it is the import span of the route traces (see instrumentation.py)
+setup_started = time.perf_counter()
+
+import functools
+import hashlib
 import sys
-from datetime import timedelta
+from datetime import date, timedelta
+from itertools import chain, islice
 from pathlib import Path
-from typing import Dict, List
-from urllib.parse import urljoin
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import urlencode, urljoin
+import xbmcaddon
 import xbmcgui
 import xbmcplugin
+import xbmcvfs
 import xbmc
 import routing
-from gql import Client, gql
-from gql.transport.requests import RequestsHTTPTransport
-
-SceneFragment = """
-fragment Scene on Scene {
-    id,
-    title,
-    details,
-    rating,
-    date,
-    o_counter,
-    paths {
-        screenshot,
-        stream
-    },
-    studio {
-        name,
-        image_path
-    },
-    tags {
-        id,
-        name,
-        image_path
-    },
-    movies {
-        movie {
-            name
-        }
-    },
-    performers {
-        name,
-        image_path
-    },
-    file {
-        duration,
-        width,
-        height,
-        audio_codec,
-        video_codec
-    },
-    scene_markers {
-        id
-    },
-    galleries {
-        images {
-            file {
-                width,
-                height
-            }
-            paths {
-                image
-            }
-        }
-    }
-}
+import requests
+import queries
+from instrumentation import Trace, append_stats, describe, load_stats, report
+from records import Gallery, Performer, Scene, Tag
+from stash_client import SERVICE_PORT_PROPERTY, StashClient, Transfer, stash_session
 
-"""
-
-GalleryFragment = """
-fragment Gallery on Gallery {
-    id,
-    title,
-    path,
-    date,
-    scenes {
-        title
-    },
-    cover {
-        paths {
-            image
-        }
-    },
-    studio {
-        name
-    },
-    images {
-        file {
-            width,
-            height
-        }
-        paths {
-            image
-        }
-    }
-}
+SEARCH_RESULT_LIMIT = 100
 
-"""
-
-PerformerFragment = """
-fragment Performer on Performer {
-    id,
-    name,
-    image_path,
-    scenes {
-        galleries {
-            title,
-            images {
-                file {
-                    width,
-                    height
-                }
-                paths {
-                    image
-                }
-            }
-        }
-    }
+# gallery covers fetched per listed performer
+PERFORMER_FANART_CANDIDATES = 4
+
+# how long cached responses are served before Stash is asked again
+LISTING_CACHE_TTL = timedelta(minutes=5)
+DETAIL_CACHE_TTL = timedelta(minutes=30)
+ARTWORK_CACHE_TTL = timedelta(hours=6)
+
+# performers, tags and studios referenced by listed scenes, shared across listings
+ENTITY_CACHE_TTL = timedelta(hours=1)
+
+# total time allowed for refreshing stale responses after a directory was rendered
+REVALIDATE_BUDGET = timedelta(seconds=30)
+
+# operations sent to Stash at once by execute_all(), the rest wait for a free connection
+MAX_CONCURRENT_REQUESTS = 4
+
+# longest another invocation's identical request is waited for before sending it again (see ResponseCache.claim)
+SINGLE_FLIGHT_TIMEOUT = timedelta(seconds=60)
+
+# listings with pages this long (or unpaged) are streamed record by record instead of cached whole
+STREAMING_PAGE_SIZE = 500
+
+# streamed records are built this many at a time, so the entities they reference are fetched together
+STREAMING_BATCH_SIZE = 200
+
+# home screen widgets: never more items than this, cached for long (stale ones are shown and refreshed afterwards),
+# and Stash isn't waited on for longer than the latency budget
+WIDGET_ITEM_LIMIT = 50
+WIDGET_CACHE_TTL = timedelta(minutes=30)
+WIDGET_LATENCY_BUDGET = timedelta(milliseconds=500)
+
+# widget -> (sort, direction, scene filter) of the scenes it shows, the random order changes with the cache period
+SCENE_WIDGETS = {
+    'recent': ('created_at', 'DESC', {}),
+    'top_rated': ('rating', 'DESC', {'rating': {'value': 0, 'modifier': 'GREATER_THAN'}}),
+    'random': ('random', None, {})
 }
 
-"""
+# URL query arguments of scene and gallery listings, carried over to the next page:
+#
+#   page          page number
+#   sort          Stash sort field (date, rating, o_counter, play_count, title, created_at, ...) or random
+#   direction     ASC or DESC
+#   seed          of the random order, picked when the listing is first opened so the next pages continue it
+#   min_rating    1-5
+#   resolution    a ResolutionEnum value like FULL_HD, scenes only
+#   min_duration  minutes, scenes only
+#   max_duration  minutes, scenes only
+#   studio        studio id
+LISTING_ARGUMENTS = ('page', 'sort', 'direction', 'seed', 'min_rating', 'resolution', 'min_duration', 'max_duration',
+                     'studio')
+
+# the arguments that filter, which the library mirror can't answer
+FILTER_ARGUMENTS = ('min_rating', 'resolution', 'min_duration', 'max_duration', 'studio')
+
+# sorts galleries don't have, they're listed in Stash's default order instead (e.g. next to a performer's scenes)
+SCENE_ONLY_SORTS = ('o_counter', 'play_count', 'duration', 'bitrate', 'framerate', 'filesize')
+
+# Kodi log level of the per route timings, by the performance_log_level setting
+PERFORMANCE_LOG_LEVELS = [None, xbmc.LOGDEBUG, xbmc.LOGINFO]
 
 
 plugin = routing.Plugin()
+addon = xbmcaddon.Addon()
+
+# settings are read via the addon, as RunPlugin invocations have no valid handle
+stash_url = addon.getSetting('url')
+hide_unorganised = addon.getSetting('hide_unorganised') == 'true'
+page_size = int(addon.getSetting('page_size') or 0)
+cache_enabled = addon.getSetting('cache_enabled') == 'true'
+cache_size = int(addon.getSetting('cache_size') or 0)  # MiB
+stale_while_revalidate = addon.getSetting('stale_while_revalidate') == 'true'
+request_timeout = int(addon.getSetting('request_timeout') or 0) or None  # seconds
+mirror_enabled = addon.getSetting('mirror_enabled') == 'true'
+fanart_rotation = addon.getSetting('fanart_rotation') == 'true'
+prefetch_enabled = addon.getSetting('prefetch_artwork') == 'true'
+widget_limit = int(addon.getSetting('widget_limit') or 0)
+performance_log_level = PERFORMANCE_LOG_LEVELS[int(addon.getSetting('performance_log_level') or 0)]
+performance_stats = addon.getSetting('performance_stats') == 'true'
+
+xbmc.log(f'{sys.argv}, {plugin.handle}, {stash_url}, {hide_unorganised}, {page_size}', xbmc.LOGINFO)
+
+
+def log_transfer(transfer: Transfer):
+    xbmc.log(f'{transfer.operation}: {transfer.transferred} bytes transferred, {transfer.decoded} decoded '
+             f'in {transfer.elapsed * 1000:.0f}ms', xbmc.LOGDEBUG)
+
+    trace.add('request', transfer.elapsed)
+    trace.add('decode', transfer.decoding)
+    trace.count('requests')
+    trace.count('transferred', transfer.transferred)
+    trace.count('decoded', transfer.decoded)
+
+
+direct_client = StashClient(urljoin(stash_url, '/graphql'), request_timeout, on_transfer=log_transfer)
+
+# go through the background service (and its warm connections) when it is running
+service_port = xbmcgui.Window(10000).getProperty(SERVICE_PORT_PROPERTY)
+# the service retries on its side, a dead service is detected without retrying and connected around
+client = StashClient(f'http://127.0.0.1:{service_port}/graphql', request_timeout, stash_session(retries=0),
+                     on_transfer=log_transfer) if service_port else direct_client
+
+profile_path = Path(xbmcvfs.translatePath(addon.getAddonInfo('profile')))
+profile_path.mkdir(parents=True, exist_ok=True)
+
+
+# optional modules are imported on demand, every click pays for imports in a fresh process
+
+def open_cache():
+    if not cache_enabled:
+        return None
+
+    from cache import ResponseCache
+    return ResponseCache(profile_path / 'cache.db', cache_size * 1024 * 1024, urljoin(stash_url, '/graphql'))
+
+
+def open_mirror():
+    # kept up to date by the background service
+    if not mirror_enabled:
+        return None
+
+    from mirror import LibraryMirror
+    return LibraryMirror(profile_path / 'library.db')
+
+
+cache = open_cache()
+mirror = open_mirror()
+
+
+# stale responses served by this invocation, refreshed by revalidate() once the directory is rendered
+pending_revalidations = []
+
+# (cache key, future) of widget requests that missed the latency budget, cached by store_late_responses()
+late_responses = []
+
+# set once Stash couldn't be reached and cached responses were served instead
+offline = False
+
+# fanart stays the same within a period, so Kodi's texture cache keeps hitting
+fanart_period = date.today().isoformat() if fanart_rotation else ''
+
+# fanart picked by this invocation, remembered by end_of_directory()
+chosen_fanart = {}
+
+# urls of the proxied artwork in this directory, warmed by prefetch_artwork(). The service writes every variant of
+# an image from one download, so each url is prefetched once, as its thumb.
+artwork = {}
+
+# route and route arguments of the next page, if the directory has one
+next_page = None
+
+# set while the next page is built for prefetching only, nothing is handed to Kodi then
+prefetching = False
+
+# timings of the route being run, replaced for every traced route handler
+trace = Trace('startup')
+
+# kind -> id -> entity, the part of the entity store this invocation has seen
+known_entities = {
+    'performers': {},
+    'tags': {},
+    'studios': {}
+}
+
+
+def document(name: str) -> str:
+    with trace.span('query'):
+        return queries.document(name)
+
+
+def fetch(document: str, variables: Dict = None, fresh: bool = False) -> Dict:
+    global client
+
+    try:
+        return client.execute(document, variables, fresh)
+
+    except requests.exceptions.ConnectionError as e:
+        if client is direct_client:
+            raise
+
+        xbmc.log(f'Stash service unreachable, connecting directly: {e}', xbmc.LOGWARNING)
+
+        client = direct_client
+        return client.execute(document, variables, fresh)
+
+
+def went_offline(error: Exception):
+    global offline
+
+    xbmc.log(f'Stash unreachable, serving cached response: {error}', xbmc.LOGWARNING)
+
+    if not offline:
+        xbmcgui.Dialog().notification('Stash', 'Server unreachable, showing cached results',
+                                      xbmcgui.NOTIFICATION_WARNING)
+
+    offline = True
+
+
+def send_all(operations: List[Tuple[str, Optional[Dict], timedelta]], pending: List[Tuple[int, Optional[str], Any]],
+             results: List[Optional[Dict]]):
+    # sends the pending (index, cache key, cached entry) operations to Stash concurrently, falling back to the
+    # cached entries if Stash can't be reached
+    def attempt(document: str, variables: Optional[Dict]):
+        try:
+            return fetch(document, variables), None
+
+        except requests.exceptions.RequestException as e:
+            return None, e
+
+    sent = [operations[i][:2] for i, key, entry in pending]
+
+    if len(sent) > 1:
+        from concurrent.futures import ThreadPoolExecutor
+
+        with ThreadPoolExecutor(max_workers=min(len(sent), MAX_CONCURRENT_REQUESTS)) as executor:
+            outcomes = list(executor.map(lambda operation: attempt(*operation), sent))
+
+    else:
+        outcomes = [attempt(*operation) for operation in sent]
+
+    for (i, key, entry), (result, error) in zip(pending, outcomes):
+        if error is not None:
+            if entry is None:
+                raise error
+
+            went_offline(error)
+            results[i] = entry.value
+            continue
+
+        if cache is not None:
+            with trace.span('cache'):
+                cache.put(key, result, operations[i][2])
+
+        results[i] = result
+
+
+def execute_all(operations: List[Tuple[str, Optional[Dict], timedelta]]) -> List[Dict]:
+    # independent (document, variables, ttl) operations, each cached on its own and sent to Stash concurrently,
+    # unless another invocation is already sending it: then its response is shared through the cache
+    results = [None] * len(operations)
+    pending = []
+    waiting = []
+
+    for i, (document, variables, ttl) in enumerate(operations):
+        with trace.span('cache'):
+            key = cache.key(document, variables) if cache is not None else None
+            entry = cache.get(key) if cache is not None else None
+
+        if entry is not None:
+            trace.count('cached')
+
+            if entry.fresh:
+                results[i] = entry.value
+                continue
+
+            if stale_while_revalidate:
+                pending_revalidations.append((key, document, variables, ttl, entry.value))
+                results[i] = entry.value
+                continue
+
+        if cache is not None:
+            with trace.span('cache'):
+                claimed = cache.claim(key, SINGLE_FLIGHT_TIMEOUT)
+
+            if not claimed:
+                waiting.append((i, key, entry))
+                continue
+
+        pending.append((i, key, entry))
+
+    try:
+        send_all(operations, pending, results)
+
+    finally:
+        if cache is not None:
+            with trace.span('cache'):
+                for i, key, entry in pending:
+                    cache.release(key)
+
+    # sent again if the other invocation failed
+    unanswered = []
+
+    for i, key, entry in waiting:
+        with trace.span('wait'):
+            shared = cache.wait(key)
+
+        if shared is None:
+            unanswered.append((i, key, entry))
+            continue
+
+        trace.count('shared')
+        results[i] = shared.value
+
+    send_all(operations, unanswered, results)
+
+    return results
+
+
+def execute(document: str, variables: Dict = None, ttl: timedelta = LISTING_CACHE_TTL) -> Dict:
+    return execute_all([(document, variables, ttl)])[0]
 
-stash_url = xbmcplugin.getSetting(plugin.handle, 'url')
-hide_unorganised = xbmcplugin.getSetting(plugin.handle, 'hide_unorganised') == 'true'
 
-xbmc.log(f'{sys.argv}, {plugin.handle}, {stash_url}, {hide_unorganised}', xbmc.LOGINFO)
+def streamed() -> bool:
+    return page_size <= 0 or page_size >= STREAMING_PAGE_SIZE
 
-transport = RequestsHTTPTransport(urljoin(stash_url, '/graphql'))
-client = Client(transport=transport)
+
+def batched(elements: Iterator, size: int) -> Iterator[List]:
+    while True:
+        batch = list(islice(elements, size))
+        if len(batch) == 0:
+            return
+
+        yield batch
+
+
+def stream(document: str, variables: Dict, path: Tuple[str, ...],
+           records: Callable[[List[Dict]], List]) -> Tuple[Dict, Iterator]:
+    # bypasses the service and the cache, both would hold the whole response in memory. So streamed listings are
+    # never cached, there is no offline fallback or stale-while-revalidate for them (see the page_size setting).
+    fields, elements = direct_client.stream(document, variables, path)
+
+    return fields, chain.from_iterable(map(records, batched(elements, STREAMING_BATCH_SIZE)))
+
+
+def find_records(operation: str, variables: Dict, path: Tuple[str, str],
+                 records: Callable[[List[Dict]], List]) -> Tuple[int, List]:
+    # the response is only referenced in here, so it's freed as soon as the compact records are built
+    field, entities = path
+    result = execute(document(operation), variables)[field]
+
+    return result['count'], records(result[entities])
+
+
+def prefetch_artwork():
+    global prefetching
+
+    if not prefetch_enabled or not service_port:
+        return
+
+    # building the next page also leaves its response in the cache for when it's opened. Streamed pages aren't
+    # cached, building one would only download it to throw it away.
+    if next_page is not None and not streamed():
+        handler, handler_kwargs = next_page
+
+        prefetching = True
+        plugin.args = {**plugin.args, 'page': [str(current_page() + 1)]}
+
+        try:
+            handler(**handler_kwargs)
+
+        except requests.exceptions.RequestException as e:
+            xbmc.log(f'Prefetching the next page failed: {e}', xbmc.LOGWARNING)
+
+    if len(artwork) == 0:
+        return
+
+    try:
+        requests.post(f'http://127.0.0.1:{service_port}/prefetch', json=[(url, 'thumb') for url in artwork],
+                      timeout=request_timeout)
+
+    except requests.exceptions.RequestException as e:
+        xbmc.log(f'Stash service unreachable, artwork not prefetched: {e}', xbmc.LOGWARNING)
+
+
+def revalidate():
+    if len(pending_revalidations) == 0:
+        return
+
+    deadline = time.monotonic() + REVALIDATE_BUDGET.total_seconds()
+    changed = False
+
+    for key, document, variables, ttl, stale_result in pending_revalidations:
+        if time.monotonic() > deadline:
+            xbmc.log('Revalidation budget exhausted, remaining responses stay stale', xbmc.LOGINFO)
+            break
+
+        # another invocation is refreshing it already
+        if not cache.claim(key, SINGLE_FLIGHT_TIMEOUT):
+            continue
+
+        # the service's memory cache may still hold the stale response
+        try:
+            result = fetch(document, variables, fresh=True)
+
+        except requests.exceptions.RequestException as e:
+            xbmc.log(f'Revalidation failed: {e}', xbmc.LOGWARNING)
+            break
+
+        else:
+            cache.put(key, result, ttl)
+            changed |= result != stale_result
+
+        finally:
+            cache.release(key)
+
+    # only refresh if the user is still looking at this directory
+    if changed and xbmc.getInfoLabel('Container.FolderPath') == sys.argv[0] + sys.argv[2]:
+        xbmc.executebuiltin('Container.Refresh')
+
+
+def store_late_responses():
+    # so the widget is there the next time the home screen is shown
+    for key, future in late_responses:
+        try:
+            cache.put(key, future.result(), WIDGET_CACHE_TTL)
+
+        except requests.exceptions.RequestException as e:
+            xbmc.log(f'Stash widget request failed: {e}', xbmc.LOGWARNING)
+
+        finally:
+            cache.release(key)
+
+
+# (url, item, is folder) of the directory being built, handed to Kodi at once by end_of_directory()
+directory_items = []
+
+# when the first item of the directory was built, for throughput logging
+items_started = None
+
+
+def list_item(label: str) -> xbmcgui.ListItem:
+    global items_started
+
+    if items_started is None:
+        items_started = time.perf_counter()
+
+    # offscreen items skip the GUI lock Kodi takes for every on-screen ListItem
+    return xbmcgui.ListItem(label=label, offscreen=True)
+
+
+def add_directory_item(url: str, item: xbmcgui.ListItem, is_folder: bool = False):
+    directory_items.append((url, item, is_folder))
+
+
+def end_of_directory(**kwargs):
+    count = len(directory_items)
+
+    trace.count('items', count)
+    if items_started is not None:
+        trace.add('build', time.perf_counter() - items_started)
+
+    if prefetching:
+        return
+
+    with trace.span('render'):
+        if count > 0:
+            xbmcplugin.addDirectoryItems(plugin.handle, directory_items, count)
+
+        xbmcplugin.endOfDirectory(plugin.handle, **kwargs)
+
+    if cache is not None and len(chosen_fanart) > 0:
+        with trace.span('cache'):
+            cache.remember_fanart(chosen_fanart, fanart_period)
+
+
+def finish_trace():
+    record = trace.finish()
+
+    if performance_log_level is not None:
+        xbmc.log(describe(record), performance_log_level)
+
+    if performance_stats:
+        append_stats(profile_path / 'stats.jsonl', record)
+
+
+def route(pattern: str):
+    # plugin.route, with the handler traced
+    def decorator(handler: Callable) -> Callable:
+        @functools.wraps(handler)
+        def traced(*args, **kwargs):
+            global trace, items_started
+
+            # the next page, built after the directory was handed over, is traced on its own
+            trace = Trace(f'{handler.__name__} (prefetch)' if prefetching else handler.__name__)
+            if not prefetching:
+                trace.add('import', trace.started - setup_started)
+
+            items_started = None
+            directory_items.clear()
+
+            try:
+                return handler(*args, **kwargs)
+
+            finally:
+                finish_trace()
+
+        return plugin.route(pattern)(traced)
+
+    return decorator
+
+
+def set_content(content: str):
+    if not prefetching:
+        xbmcplugin.setContent(plugin.handle, content)
+
+
+def set_category(category: str):
+    if prefetching:
+        return
+
+    if offline:
+        category += ' (offline)'
+
+    xbmcplugin.setPluginCategory(plugin.handle, category)
+
+
+def image_url(url: Optional[str], variant: str) -> Optional[str]:
+    # gallery images are downscaled (variant 'thumb' or 'screen') and cached by the background service
+    if url is None or not service_port:
+        return url
+
+    artwork[url] = None
+
+    return f'http://127.0.0.1:{service_port}/image?' + urlencode({'url': url, 'size': variant})
 
 
 def common_item_info(mediatype: str):
@@ -140,38 +551,307 @@ def common_item_info(mediatype: str):
     }
 
 
-def random_fanart_from_gallery(gallery: Dict):
+def page_state() -> Dict[str, str]:
+    # page, sort and filter state carried in the route URL query string (see LISTING_ARGUMENTS)
+    if plugin.args.get('sort') == ['random'] and 'seed' not in plugin.args:
+        plugin.args['seed'] = [str(int(time.time()))]
+
+    return {k: v[0] for k, v in plugin.args.items() if k in LISTING_ARGUMENTS}
+
+
+def current_page() -> int:
+    return max(int(page_state().get('page', 1)), 1)
+
+
+def find_filter(kind: str = None) -> Dict:
+    state = page_state()
+
+    if kind == 'galleries' and state.get('sort') in SCENE_ONLY_SORTS:
+        state = {k: v for k, v in state.items() if k not in ('sort', 'direction')}
+
+    filter = {
+        'page': current_page(),
+        'per_page': page_size,  # 0 fetches everything in one go
+        # Stash shuffles by random_<seed> the same way every time
+        'sort': f'random_{state["seed"]}' if state.get('sort') == 'random' else state.get('sort'),
+        'direction': state.get('direction')
+    }
+
+    return {k: v for k, v in filter.items() if v is not None}
+
+
+def listing_filter(kind: str, related: Tuple[str, str] = None) -> Dict:
+    # scene_filter or gallery_filter of a listing: the filters in the route URL, the hide_unorganised setting and the
+    # (kind, id) of the entity whose scenes or galleries are listed
+    state = page_state()
+    criteria = {}
+
+    if hide_unorganised:
+        criteria['organized'] = True
+
+    if related is not None:
+        criteria[related[0]] = {'value': [related[1]], 'modifier': 'INCLUDES'}
+
+    if 'studio' in state:
+        criteria['studios'] = {'value': [state['studio']], 'modifier': 'INCLUDES'}
+
+    if 'min_rating' in state:
+        criteria['rating'] = {'value': int(state['min_rating']) - 1, 'modifier': 'GREATER_THAN'}
+
+    if kind != 'scenes':
+        return criteria
+
+    if 'resolution' in state:
+        criteria['resolution'] = {'value': state['resolution'].upper(), 'modifier': 'EQUALS'}
+
+    # seconds, both ends inclusive
+    shortest = int(state['min_duration']) * 60 if 'min_duration' in state else None
+    longest = int(state['max_duration']) * 60 if 'max_duration' in state else None
+
+    if shortest is not None and longest is not None:
+        criteria['duration'] = {'value': shortest, 'value2': longest, 'modifier': 'BETWEEN'}
+
+    elif shortest is not None:
+        criteria['duration'] = {'value': shortest - 1, 'modifier': 'GREATER_THAN'}
+
+    elif longest is not None:
+        criteria['duration'] = {'value': longest + 1, 'modifier': 'LESS_THAN'}
+
+    return criteria
+
+
+def find_mirrored(kind: str, records: Callable[[List[Dict]], List] = None,
+                  related: Tuple[str, str] = None) -> Optional[Tuple[int, List]]:
+    # answers a listing page from the local library mirror, None if it can't
+    state = page_state()
+
+    if mirror is None or any(argument in state for argument in FILTER_ARGUMENTS):
+        return None
+
+    mirrored = mirror.find(kind,
+                           page=current_page(),
+                           per_page=page_size,
+                           sort=f'random_{state["seed"]}' if state.get('sort') == 'random' else state.get('sort'),
+                           direction=state.get('direction'),
+                           organized=hide_unorganised and kind in ('scenes', 'galleries'),
+                           related=related)
+
+    if mirrored is None or records is None:
+        return mirrored
+
+    count, entities = mirrored
+    return count, records(entities)
+
+
+def page_count(count: int) -> int:
+    if page_size <= 0:
+        return 1
+
+    return max((count + page_size - 1) // page_size, 1)
+
+
+def set_paged_category(title: str, count: int):
+    category = f'{title} ({count})'
+
+    pages = page_count(count)
+    if pages > 1:
+        category += f' - Page {current_page()} of {pages}'
+
+    set_category(category)
+
+
+def add_next_page_item(route, count: int, **route_kwargs):
+    global next_page
+
+    page = current_page()
+    pages = page_count(count)
+
+    if page >= pages:
+        return
+
+    next_page = (route, route_kwargs)
+
+    item = list_item(f'[I]Next page ({page + 1} of {pages})[/I]')
+
+    url = plugin.url_for(route, **route_kwargs, **{**page_state(), 'page': page + 1})
+    add_directory_item(url, item, is_folder=True)
+
+
+def stable_choice(seed: str, choices: List):
+    # the same seed picks the same element (for the current fanart period), unlike random.choice
+    digest = hashlib.sha1(f'{seed}:{fanart_period}'.encode('utf-8')).digest()
+
+    return choices[int.from_bytes(digest[:8], 'big') % len(choices)]
+
+
+def recalled_fanart(key: str) -> Optional[str]:
+    # the candidates differ between listings (e.g. performer covers), so a pick is kept for the period
+    return cache.fanart(key, fanart_period) if cache is not None else None
+
+
+def remembered_fanart(key: str, choose: Callable[[], Optional[str]]) -> Optional[str]:
+    url = recalled_fanart(key)
+
+    if url is None:
+        url = choose()
+
+        if url is not None:
+            chosen_fanart[key] = url
+
+    return url
+
+
+def fanart_from_images(seed: str, images: List[Dict]) -> Optional[str]:
     # landscape images work best
     def wide_images():
-        for image in gallery['images']:
+        for image in images:
             aspect = image['file']['width'] / max(image['file']['height'], 1)
 
             if aspect >= 1:
                 yield image
 
-    images = list(wide_images())
-    if len(images) == 0:
-        images = gallery['images']  # fallback to portrait if no landscape images were found
+    candidates = list(wide_images())
+    if len(candidates) == 0:
+        candidates = images  # fallback to portrait if no landscape images were found
 
-    if len(images) == 0:
+    if len(candidates) == 0:
         return None
 
-    # a pic midway through the gallery is usually more "interesting"
-    #image = images[int(len(images) / 2)]
+    return stable_choice(seed, candidates)['paths']['image']
+
+
+def gallery_fanart(gallery: Dict):
+    # only scene_contents fetches the images of a gallery (see GalleryDetail), listings reuse a pick remembered from
+    # there or fall back to the cover
+    if 'images' in gallery:
+        return remembered_fanart(f'gallery:{gallery["id"]}',
+                                 lambda: fanart_from_images(f'gallery:{gallery["id"]}', gallery['images']))
+
+    cover = gallery['cover']
+    return recalled_fanart(f'gallery:{gallery["id"]}') or (cover['paths']['image'] if cover is not None else None)
+
+
+def remember_entities(kind: str, entities: List[Dict]):
+    if len(entities) == 0:
+        return
+
+    known_entities[kind].update((e['id'], e) for e in entities)
+
+    if cache is not None:
+        cache.put_entities(kind, entities, ENTITY_CACHE_TTL)
+
+
+def known(kind: str, ids: List[str]) -> Dict[str, Dict]:
+    # entities seen by this invocation, or stored by an earlier one
+    found = {i: known_entities[kind][i] for i in ids if i in known_entities[kind]}
+
+    missing = [i for i in ids if i not in found]
+    if len(missing) > 0 and cache is not None:
+        stored = cache.entities(kind, missing)
+
+        known_entities[kind].update(stored)
+        found.update(stored)
+
+    return found
+
+
+def resolve_scenes(scenes: List[Dict]) -> List[Dict]:
+    # listed scenes reference their studio, tags and performers by id, the mirror and detail views embed them
+    def references(scene: Dict) -> Iterator[Tuple[str, Dict]]:
+        if scene['studio'] is not None:
+            yield 'studios', scene['studio']
+
+        yield from (('tags', t) for t in scene['tags'])
+        yield from (('performers', p) for p in scene['performers'])
+
+    # kind -> unique referenced ids, in order of appearance
+    ids = {kind: {} for kind in known_entities}
+    for scene in scenes:
+        for kind, reference in references(scene):
+            if 'name' not in reference:
+                ids[kind][reference['id']] = None
+
+    entities = {kind: known(kind, list(kind_ids)) for kind, kind_ids in ids.items()}
+    missing = {kind: [i for i in kind_ids if i not in entities[kind]] for kind, kind_ids in ids.items()}
+
+    # everything not in the store yet is looked up at once, a batch of ids per request
+    batches = [(kind, batch) for kind, kind_ids in missing.items()
+               for batch in batched(iter(kind_ids), queries.BATCH_SIZE)]
+
+    if len(batches) > 0:
+        try:
+            results = execute_all([(document(f'Entity{kind.capitalize()}'), queries.batch_variables(batch),
+                                    ENTITY_CACHE_TTL) for kind, batch in batches])
+
+        except requests.exceptions.RequestException as e:
+            # the batches differ from listing to listing, so they're rarely cached: the store keeps expired
+            # entities for this
+            if cache is None:
+                raise
+
+            went_offline(e)
+            results = []
+
+            for kind, kind_ids in missing.items():
+                entities[kind].update(cache.entities(kind, kind_ids, expired=True))
+
+        for (kind, batch), result in zip(batches, results):
+            # None for ids Stash doesn't know
+            fetched = [e for e in queries.batch_results(result, batch).values() if e is not None]
+
+            remember_entities(kind, fetched)
+            entities[kind].update((e['id'], e) for e in fetched)
+
+    def resolve(kind: str, reference: Dict) -> Optional[Dict]:
+        # None for entities deleted since the listing was fetched
+        return reference if 'name' in reference else entities[kind].get(reference['id'])
+
+    return [{
+        **scene,
+        'studio': resolve('studios', scene['studio']) if scene['studio'] is not None else None,
+        'tags': [t for t in (resolve('tags', t) for t in scene['tags']) if t is not None],
+        'performers': [p for p in (resolve('performers', p) for p in scene['performers']) if p is not None]
+    } for scene in scenes]
+
+
+def scene_record(scene: Dict) -> Scene:
+    # the fanart is picked while the scene's galleries are still around
+    fanart_url = None
+    if len(scene['galleries']) > 0:
+        fanart_url = remembered_fanart(
+            f'scene:{scene["id"]}',
+            lambda: gallery_fanart(stable_choice(f'scene:{scene["id"]}', scene['galleries']))
+        )
+
+    return Scene.decode(scene, fanart_url)
+
 
-    image = random.choice(images)
+def scene_records(scenes: List[Dict]) -> List[Scene]:
+    return [scene_record(s) for s in resolve_scenes(scenes)]
 
-    return image['paths']['image']
 
+def gallery_record(gallery: Dict) -> Gallery:
+    return Gallery.decode(gallery, gallery_fanart(gallery))
 
-def scene_directory_item(scene, label_format='{title}') -> xbmcgui.ListItem:
-    title = scene['title']
-    screenshot_url = scene['paths']['screenshot']
-    gallery_count = len(scene['galleries'])
-    studio = scene['studio']
-    tag_names = [t['name'] for t in scene['tags']]
 
-    item = xbmcgui.ListItem(label=label_format.format(**scene))
+def gallery_records(galleries: List[Dict]) -> List[Gallery]:
+    return [gallery_record(g) for g in galleries]
+
+
+def performer_records(performers: List[Dict]) -> List[Performer]:
+    remember_entities('performers', performers)
+
+    return [Performer.decode(p) for p in performers]
+
+
+def tag_records(tags: List[Dict]) -> List[Tag]:
+    remember_entities('tags', tags)
+
+    return [Tag.decode(t) for t in tags]
+
+
+def scene_directory_item(scene: Scene, label_format='{title}') -> xbmcgui.ListItem:
+    item = list_item(label_format.format(**scene._asdict()))
 
     def plot():
         def fj(l, s):
@@ -181,56 +861,52 @@ def scene_directory_item(scene, label_format='{title}') -> xbmcgui.ListItem:
             return s.join(filter(None, l))
 
         items = {
-            'Performers': fj([p['name'] for p in scene['performers']], ', '),
-            'Studio': studio['name'] if studio else None,
-            'Tags': fj(tag_names, ', ')
+            'Performers': fj([name for name, image_path in scene.cast], ', '),
+            'Studio': scene.studio_name,
+            'Tags': fj(scene.tag_names, ', ')
         }
 
         labels = '\n\n'.join([f'[B]{k}:[/B] {v}' for k, v in items.items() if v is not None])
 
-        parts = [labels, scene["details"]]
+        parts = [labels, scene.details]
 
         return fj(parts, '\n\n')
 
     item.setInfo('video', {
-        'title': title,
-        'premiered': scene['date'],
-        'studio': studio['name'] if studio else None,
-        'duration': scene['file']['duration'],
-        'tag': tag_names,
+        'title': scene.title,
+        'premiered': scene.date,
+        'studio': scene.studio_name,
+        'duration': scene.duration,
+        'tag': list(scene.tag_names),
         'plot': plot(),
 
-        'votes': f'{scene["o_counter"]} orgasms',
+        'votes': f'{scene.o_counter} orgasms',
         #**common_item_info('video')
     })
 
     item.setCast([
         {
-            'name': p['name'],
-            'thumbnail': p['image_path']
+            'name': name,
+            'thumbnail': image_path
         }
-        for p in scene['performers']
+        for name, image_path in scene.cast
     ])
 
     item.addStreamInfo('video', {
-        'codec': scene['file']['video_codec'],
-        'width': scene['file']['width'],
-        'height': scene['file']['height']
+        'codec': scene.video_codec,
+        'width': scene.width,
+        'height': scene.height
     })
 
     item.addStreamInfo('audio', {
-        'codec': scene['file']['audio_codec']
+        'codec': scene.audio_codec
     })
 
     # use a gallery cover for the fanart (if available)
-    fanart_url = screenshot_url
-    if gallery_count > 0:
-        fanart_url = random_fanart_from_gallery(random.choice(scene['galleries']))
-
     item.setArt({
-        'thumb': screenshot_url,
-        'fanart': fanart_url,
-        'clearlogo': studio['image_path'] if studio else None
+        'thumb': image_url(scene.screenshot, 'thumb'),
+        'fanart': image_url(scene.fanart or scene.screenshot, 'screen'),
+        'clearlogo': scene.studio_image
     })
 
     # item.addContextMenuItems([
@@ -240,177 +916,149 @@ def scene_directory_item(scene, label_format='{title}') -> xbmcgui.ListItem:
     return item
 
 
-def add_scene_directory_item(scene, leaf=False, **kwargs):
-    stream_url = scene['paths']['stream']
-    marker_count = len(scene['scene_markers'])
-    gallery_count = len(scene['galleries'])
-
+def add_scene_directory_item(scene: Scene, leaf=False, **kwargs):
     item = scene_directory_item(scene, **kwargs)
 
 
-
     if not leaf:
         #and (marker_count > 0 or gallery_count > 0):
-        xbmcplugin.addDirectoryItem(plugin.handle,
-                                    plugin.url_for(scene_contents, scene_id=scene['id']),
-                                    item,
-                                    isFolder=True)
+        add_directory_item(plugin.url_for(scene_contents, scene_id=scene.id), item, is_folder=True)
 
     else:
         item.setProperty('IsPlayable', 'true')
 
-        xbmcplugin.addDirectoryItem(plugin.handle, stream_url, item)
-
+        add_directory_item(scene.stream, item)
 
-def gallery_directory_item(gallery, label_format='{title}') -> xbmcgui.ListItem:
-    def gallery_title():
-        title = gallery['title']
-        if title is not None:
-            return title
 
-        first_scene = next(iter(gallery['scenes']), None)
-        discriminator = first_scene["title"] if first_scene else Path(gallery['path']).name
-        return f'Untitled Gallery ({discriminator})'
+def gallery_directory_item(gallery: Gallery, label_format='{title}') -> xbmcgui.ListItem:
+    title = label_format.format(title=gallery.title)
+    thumbnail_url = image_url(gallery.cover, 'thumb')
 
-    title = label_format.format(title=gallery_title())
-    studio = gallery['studio']
-    cover_image_url = gallery['cover']['paths']['image'] if gallery['cover'] is not None else None
-
-    item = xbmcgui.ListItem(label=title)
+    item = list_item(title)
 
     item.setInfo('folder', {
         'title': title,
-        'studio': studio['name'] if studio else None,
+        'studio': gallery.studio_name,
         **common_item_info('folder')
     })
 
     item.setArt({
-        'thumb': cover_image_url,
-        'icon': cover_image_url,
-        'poster': cover_image_url,
-        'fanart': random_fanart_from_gallery(gallery) or cover_image_url,
+        'thumb': thumbnail_url,
+        'icon': thumbnail_url,
+        'poster': thumbnail_url,
+        'fanart': image_url(gallery.fanart or gallery.cover, 'screen'),
     })
 
     return item
 
 
-def add_gallery_directory_item(gallery, **kwargs):
+def add_gallery_directory_item(gallery: Gallery, **kwargs):
     item = gallery_directory_item(gallery, **kwargs)
 
-    xbmcplugin.addDirectoryItem(plugin.handle,
-                                plugin.url_for(gallery_contents, gallery_id=gallery['id']),
-                                item,
-                                isFolder=True)
+    add_directory_item(plugin.url_for(gallery_contents, gallery_id=gallery.id), item, is_folder=True)
 
 
-def performer_directory_item(performer, label_format='{name}'):
-    name = performer['name']
-    image_url = performer['image_path']
+def performer_fanart(performers: List[Performer]) -> Dict[str, str]:
+    fanart = {p.id: recalled_fanart(f'performer:{p.id}') for p in performers}
 
-    item = xbmcgui.ListItem(label=label_format.format(**performer))
+    # gallery covers are only looked up for performers without a remembered pick
+    performer_ids = [p.id for p in performers if p.gallery_count and fanart[p.id] is None]
+    if len(performer_ids) == 0:
+        return fanart
 
-    item.setInfo('folder', {
-        'title': name,
-        **common_item_info('folder')
-    })
+    # every performer gets their own candidates, one prolific performer would fill a shared page
+    batches = list(batched(iter(performer_ids), queries.BATCH_SIZE))
+    operation = document('PerformerGalleryCovers')
 
-    def random_gallery_fanart():
-        galleries = [gallery for scene in performer['scenes'] for gallery in scene['galleries']]
-        if len(galleries) == 0:
-            return None
+    results = execute_all([(operation, {
+        **queries.batch_variables(batch),
+        'filter': {
+            'per_page': PERFORMER_FANART_CANDIDATES
+        }
+    }, ARTWORK_CACHE_TTL) for batch in batches])
+
+    covers = {}
+    for batch, result in zip(batches, results):
+        for performer_id, galleries in queries.batch_results(result, batch).items():
+            covers[performer_id] = [g['cover'] for g in galleries['galleries'] if g['cover'] is not None]
 
-        gallery = random.choice(galleries)
+    for performer_id in performer_ids:
+        fanart[performer_id] = remembered_fanart(f'performer:{performer_id}',
+                                                 lambda: fanart_from_images(f'performer:{performer_id}',
+                                                                            covers.get(performer_id, [])))
 
-        xbmc.log(f'Picked gallery {gallery["title"]} for {name}', xbmc.LOGINFO)
+    return fanart
 
-        return random_fanart_from_gallery(gallery)
+
+def performer_directory_item(performer: Performer, label_format='{name}', fanart_url=None):
+    portrait_url = performer.image_path
+
+    item = list_item(label_format.format(**performer._asdict()))
+    item.setLabel2(f'{performer.scene_count} scenes, {performer.gallery_count} galleries')
+
+    item.setInfo('folder', {
+        'title': performer.name,
+        **common_item_info('folder')
+    })
 
     item.setArt({
-        'thumb': image_url,
-        'icon': image_url,
-        'poster': image_url,
-        'fanart': random_gallery_fanart() or image_url,
+        'thumb': portrait_url,
+        'icon': portrait_url,
+        'poster': portrait_url,
+        'fanart': image_url(fanart_url, 'screen') or portrait_url,
     })
 
     return item
 
 
-def add_performer_directory_item(performer, **kwargs):
+def add_performer_directory_item(performer: Performer, **kwargs):
     item = performer_directory_item(performer, **kwargs)
 
-    xbmcplugin.addDirectoryItem(plugin.handle,
-                                plugin.url_for(performer_contents, performer_id=performer['id']),
-                                item,
-                                isFolder=True)
+    add_directory_item(plugin.url_for(performer_contents, performer_id=performer.id), item, is_folder=True)
 
 
-def tag_directory_item(tag, label_format='{name}'):
-    item = xbmcgui.ListItem(label=label_format.format(**tag))
+def add_performer_directory_items(performers: List[Performer], **kwargs):
+    # bounded lookups for the fanart of every performer in the listing, a batch of performers at a time
+    fanart = performer_fanart(performers)
+
+    for performer in performers:
+        add_performer_directory_item(performer, fanart_url=fanart.get(performer.id), **kwargs)
+
+
+def tag_directory_item(tag: Tag, label_format='{name}'):
+    item = list_item(label_format.format(**tag._asdict()))
 
     item.setArt({
-        'thumb': tag['image_path'],
-        'icon': tag['image_path'],
-        'fanart': tag['image_path'],
+        'thumb': tag.image_path,
+        'icon': tag.image_path,
+        'fanart': tag.image_path,
     })
 
     return item
 
 
-def add_tag_directory_item(tag, **kwargs):
+def add_tag_directory_item(tag: Tag, **kwargs):
     item = tag_directory_item(tag, **kwargs)
 
-    xbmcplugin.addDirectoryItem(plugin.handle, plugin.url_for(tag_contents, tag_id=tag['id']), item, isFolder=True)
+    add_directory_item(plugin.url_for(tag_contents, tag_id=tag.id), item, is_folder=True)
 
 
-@plugin.route('/scenes/<scene_id>')
+@route('/scenes/<scene_id>')
 def scene_contents(scene_id: str):
-    query = gql(
-        SceneFragment + GalleryFragment + PerformerFragment +
-        """
-            query FindScene($id: ID!) {
-                scene: findScene(id: $id) {
-                    ... Scene,
-                    
-                    galleries {
-                        ... Gallery
-                    }
-                    
-                    scene_markers {
-                        title,
-                        preview,
-                        seconds,
-                        scene {
-                            paths {
-                                stream
-                            },
-                            file {
-                                duration
-                            }
-                        }
-                    }
-                    
-                    performers {
-                        ... Performer
-                    }
-                }
-            }
-    """
-    )
-
-    scene = client.execute(query, {
+    scene = execute(document('FindScene'), {
         'id': scene_id
-    })['scene']
+    }, ttl=DETAIL_CACHE_TTL)['scene']
 
-    xbmcplugin.setPluginCategory(plugin.handle, scene['title'])
-    xbmcplugin.setContent(plugin.handle, 'files')
+    set_category(scene['title'])
+    set_content('files')
 
     scene_stream_url = scene['paths']['stream']
     markers = scene['scene_markers']
-    galleries = scene['galleries']
-    tags = scene['tags']
-    performers = scene['performers']
+    galleries = gallery_records(scene['galleries'])
+    tags = tag_records(scene['tags'])
+    performers = performer_records(scene['performers'])
 
-    add_scene_directory_item(scene, leaf=True, label_format='[B]{title}[/B]')
+    add_scene_directory_item(scene_records([scene])[0], leaf=True, label_format='[B]{title}[/B]')
 
     for marker in markers:
         title = marker['title']
@@ -419,12 +1067,12 @@ def scene_contents(scene_id: str):
 
         offset_percent = (offset_seconds / scene_duration) * 100
 
-        item = xbmcgui.ListItem(label=f'[I]Marker:[/I] [{offset_seconds}] {title}')
+        item = list_item(f'[I]Marker:[/I] [{offset_seconds}] {title}')
         item.setInfo('video', {})
         item.setProperty('IsPlayable', 'true')
         item.setProperty('StartPercent', str(offset_percent))
 
-        xbmcplugin.addDirectoryItem(plugin.handle, scene_stream_url, item)
+        add_directory_item(scene_stream_url, item)
 
     for gallery in galleries:
         add_gallery_directory_item(gallery, label_format='[I]Gallery:[/I] {title}')
@@ -432,111 +1080,97 @@ def scene_contents(scene_id: str):
     for tag in tags:
         add_tag_directory_item(tag, label_format='[I]Tag:[/I] {name}')
 
-    for performer in performers:
-        add_performer_directory_item(performer, label_format='[I]Performer:[/I] {name}')
+    add_performer_directory_items(performers, label_format='[I]Performer:[/I] {name}')
 
 
-    xbmcplugin.endOfDirectory(plugin.handle)
+    end_of_directory()
 
 
 
-@plugin.route('/scenes')
+@route('/scenes')
 def list_scenes():
-    query = gql(
-        SceneFragment +
-        """
-            query ListScenes($organized: Boolean) {
-                allScenes: findScenes(filter: {per_page: 0}, scene_filter: {organized: $organized}) {
-                    scenes {
-                        ... Scene
-                    }
-                }
-            }
-    """
-    )
+    mirrored = find_mirrored('scenes', scene_records)
+
+    if mirrored is not None:
+        count, scenes = mirrored
+
+    elif streamed():
+        result, scenes = stream(document('ListScenes'), {
+            'filter': find_filter(),
+            'scene_filter': listing_filter('scenes')
+        }, ('allScenes', 'scenes'), scene_records)
 
-    scenes = client.execute(query, {
-        'organized': hide_unorganised or None
-    })['allScenes']['scenes']
+        count = result['allScenes']['count']
 
-    xbmcplugin.setPluginCategory(plugin.handle, 'Scenes')
-    xbmcplugin.setContent(plugin.handle, 'videos')
+    else:
+        count, scenes = find_records('ListScenes', {
+            'filter': find_filter(),
+            'scene_filter': listing_filter('scenes')
+        }, ('allScenes', 'scenes'), scene_records)
+
+    set_paged_category('Scenes', count)
+    set_content('videos')
 
     for scene in scenes:
         add_scene_directory_item(scene)
 
-    xbmcplugin.endOfDirectory(plugin.handle)
+    add_next_page_item(list_scenes, count)
+
+    end_of_directory()
 
 
-@plugin.route('/movies/<movie_id>')
+@route('/movies/<movie_id>')
 def movie_contents(movie_id: str):
-    query = gql(
-        SceneFragment +
-        """
-            query FindMovie($id: ID!, $organized: Boolean) {
-                movie: findMovie(id: $id) {
-                    name
-                },
-                
-                movieScenes: findScenes(filter: {per_page: 0}, scene_filter: {movies: {value: [$id], modifier: INCLUDES}, organized: $organized}) {
-                    scenes {
-                        ... Scene
-                    }
-                },
-            }
-    """
-    )
+    movie = mirror.get('movies', movie_id) if mirror is not None else None
+    mirrored = find_mirrored('scenes', scene_records, related=('movies', movie_id))
 
-    result = client.execute(query, {
-        'id': movie_id,
-        'organized': hide_unorganised or None
-    })
+    if movie is not None and mirrored is not None:
+        scene_count, scenes = mirrored
 
-    movie = result['movie']
-    scenes = result['movieScenes']['scenes']
+    else:
+        result = execute(document('FindMovie'), {
+            'id': movie_id,
+            'filter': find_filter(),
+            'scene_filter': listing_filter('scenes', ('movies', movie_id))
+        })
 
-    xbmcplugin.setPluginCategory(plugin.handle, movie['name'])
-    xbmcplugin.setContent(plugin.handle, 'files')
+        movie = result['movie']
+        scene_count = result['movieScenes']['count']
+        scenes = scene_records(result['movieScenes']['scenes'])
+
+    set_paged_category(movie['name'], scene_count)
+    set_content('files')
 
     for scene in scenes:
         add_scene_directory_item(scene)
 
-    xbmcplugin.endOfDirectory(plugin.handle)
+    add_next_page_item(movie_contents, scene_count, movie_id=movie_id)
+
+    end_of_directory()
 
 
-@plugin.route('/movies')
+@route('/movies')
 def list_movies():
-    query = gql(
-        """
-            query ListMovies {
-                allMovies: findMovies(filter: {per_page: 0}) {
-                    movies {
-                        id,
-                        name,
-                        synopsis,
-                        director,
-                        front_image_path,
-                        back_image_path,
-                        date
-                        studio {
-                            name
-                        },
-                    }
-                }
-            }
-    """
-    )
+    mirrored = find_mirrored('movies')
 
-    movies = client.execute(query)['allMovies']['movies']
+    if mirrored is not None:
+        count, movies = mirrored
 
-    xbmcplugin.setPluginCategory(plugin.handle, 'Movies')
-    xbmcplugin.setContent(plugin.handle, 'movies')
+    else:
+        result = execute(document('ListMovies'), {
+            'filter': find_filter()
+        })['allMovies']
+
+        count, movies = result['count'], result['movies']
+
+    set_paged_category('Movies', count)
+    set_content('movies')
 
     for movie in movies:
         title = movie['name']
         studio = movie['studio']
 
-        item = xbmcgui.ListItem(label=title)
+        item = list_item(title)
 
         item.setInfo('video', {
             'title': title,
@@ -555,44 +1189,24 @@ def list_movies():
             'fanart': movie['front_image_path'],
         })
 
-        xbmcplugin.addDirectoryItem(plugin.handle, plugin.url_for(movie_contents, movie_id=movie['id']), item, isFolder=True)
+        add_directory_item(plugin.url_for(movie_contents, movie_id=movie['id']), item, is_folder=True)
 
-    xbmcplugin.endOfDirectory(plugin.handle)
+    add_next_page_item(list_movies, count)
 
+    end_of_directory()
 
-@plugin.route('/markers')
-def list_markers():
-    query = gql(
-        """
-            query ListMarkers {
-                allMarkers: findSceneMarkers(filter: {per_page: 0}) {
-                    scene_markers {
-                        title,
-                        seconds,
-                        scene {
-                            title,
-                            paths {
-                                stream
-                            }
-                        }
-                        preview,
-                        stream,
-                        
-                    }
-                }
-            }
-    """
-    )
 
-    markers = client.execute(query)['allMarkers']['scene_markers']
+@route('/markers')
+def list_markers():
+    markers = execute(document('ListMarkers'))['allMarkers']['scene_markers']
 
-    xbmcplugin.setPluginCategory(plugin.handle, 'Markers')
-    xbmcplugin.setContent(plugin.handle, 'videos')
+    set_category('Markers')
+    set_content('videos')
 
     for marker in markers:
         title = marker['title']
 
-        item = xbmcgui.ListItem(label=title)
+        item = list_item(title)
 
         item.setInfo('video', {
             'title': title,
@@ -609,49 +1223,53 @@ def list_markers():
 
         item.setProperty('IsPlayable', 'true')
 
-        xbmcplugin.addDirectoryItem(plugin.handle, marker['stream'], item)
+        add_directory_item(marker['stream'], item)
 
-    xbmcplugin.endOfDirectory(plugin.handle)
+    end_of_directory()
 
 
-@plugin.route('/performers/<performer_id>')
+@route('/performers/<performer_id>')
 def performer_contents(performer_id: str):
-    query = gql(
-        SceneFragment + GalleryFragment +
-        """
-            query FindPerformer($id: ID!, $organized: Boolean) {
-                performer: findPerformer(id: $id) {
-                    id,
-                    name,
-                    image_path
-                }
-                
-                performerScenes: findScenes(filter: {per_page: 0}, scene_filter: {performers: {value: [$id], modifier: INCLUDES}, organized: $organized}) {
-                    scenes {
-                        ... Scene
-                    }
-                }
-                
-                performerGalleries: findGalleries(filter: {per_page: 0}, gallery_filter: {performers: {value: [$id], modifier: INCLUDES}, organized: $organized}) {
-                    galleries {
-                        ... Gallery
-                    }
-                }
-            }
-    """
-    )
+    performer = mirror.get('performers', performer_id) if mirror is not None else None
+    mirrored_scenes = find_mirrored('scenes', scene_records, related=('performers', performer_id))
+    mirrored_galleries = find_mirrored('galleries', gallery_records, related=('performers', performer_id))
 
-    result = client.execute(query, {
-        'id': performer_id,
-        'organized': hide_unorganised or None
-    })
+    if None not in (performer, mirrored_scenes, mirrored_galleries):
+        scene_count, scenes = mirrored_scenes
+        gallery_count, galleries = mirrored_galleries
+
+    else:
+        related_scenes = {
+            'filter': find_filter(),
+            'scene_filter': listing_filter('scenes', ('performers', performer_id))
+        }
+        related_galleries = {
+            'filter': find_filter('galleries'),
+            'gallery_filter': listing_filter('galleries', ('performers', performer_id))
+        }
+
+        # performers listed or referenced before are already in the entity store
+        performer = performer or known('performers', [performer_id]).get(performer_id)
 
-    performer = result['performer']
-    scenes = result['performerScenes']['scenes']
-    galleries = result['performerGalleries']['galleries']
+        scenes, galleries, *found = execute_all([
+            (document('PerformerScenes'), related_scenes, LISTING_CACHE_TTL),
+            (document('PerformerGalleries'), related_galleries, LISTING_CACHE_TTL),
+            *([(document('FindPerformer'), {'id': performer_id}, DETAIL_CACHE_TTL)] if performer is None else [])
+        ])
 
-    xbmcplugin.setPluginCategory(plugin.handle, performer['name'])
-    xbmcplugin.setContent(plugin.handle, 'files')
+        if performer is None:
+            performer = found[0]['performer']
+
+        scene_count, scenes = scenes['performerScenes']['count'], scene_records(scenes['performerScenes']['scenes'])
+        gallery_count, galleries = galleries['performerGalleries']['count'], gallery_records(
+            galleries['performerGalleries']['galleries']
+        )
+
+    # scenes and galleries are paged side by side
+    count = max(scene_count, gallery_count)
+
+    set_paged_category(performer['name'], count)
+    set_content('files')
 
     for scene in scenes:
         add_scene_directory_item(scene, label_format='Scene: {title}')
@@ -659,101 +1277,70 @@ def performer_contents(performer_id: str):
     for gallery in galleries:
         add_gallery_directory_item(gallery, label_format='Gallery: {title}')
 
+    add_next_page_item(performer_contents, count, performer_id=performer_id)
 
-    xbmcplugin.endOfDirectory(plugin.handle)
+    end_of_directory()
 
 
 
-@plugin.route('/performers')
+@route('/performers')
 def list_performers():
-    query = gql(
-        PerformerFragment +
-        """
-            query ListPerformers {
-                allPerformers: findPerformers(filter: {per_page: 0}) {
-                    performers {
-                        ... Performer
-                    }
-                }
-            }
-    """
-    )
+    mirrored = find_mirrored('performers', performer_records)
 
-    performers = client.execute(query)['allPerformers']['performers']
+    if mirrored is not None:
+        count, performers = mirrored
 
-    xbmcplugin.setPluginCategory(plugin.handle, 'Performers')
-    xbmcplugin.setContent(plugin.handle, 'artists')
+    else:
+        count, performers = find_records('ListPerformers', {
+            'filter': find_filter()
+        }, ('allPerformers', 'performers'), performer_records)
 
-    for performer in performers:
-        add_performer_directory_item(performer)
+    set_paged_category('Performers', count)
+    set_content('artists')
 
-    xbmcplugin.endOfDirectory(plugin.handle)
+    add_performer_directory_items(performers)
 
+    add_next_page_item(list_performers, count)
 
-@plugin.route('/studios')
+    end_of_directory()
+
+
+@route('/studios')
 def list_studios():
     return
 
 
-@plugin.route('/galleries/<gallery_id>')
+@route('/galleries/<gallery_id>')
 def gallery_contents(gallery_id: str):
-    query = gql(
-        SceneFragment + PerformerFragment +
-        """
-            query FindGallery($id: ID!) {
-                gallery: findGallery(id: $id) {
-                    title,
-                    images {
-                        title,
-                        file {
-                            width,
-                            height,
-                            size
-                        },
-                        paths {
-                            image
-                        },
-                        studio {
-                            name
-                        }
-                    },
-                    performers {
-                        ... Performer
-                    }
-                    scenes {
-                        ... Scene
-                    }
-                }
-            }
-    """
-    )
-
-    gallery = client.execute(query, {
+    gallery = execute(document('FindGallery'), {
         'id': gallery_id
-    })['gallery']
+    }, ttl=DETAIL_CACHE_TTL)['gallery']
 
-    xbmcplugin.setPluginCategory(plugin.handle, gallery['title'])
-    xbmcplugin.setContent(plugin.handle, 'images')
+    set_category(gallery['title'])
+    set_content('images')
 
     images = gallery['images']
-    scenes = gallery['scenes']
-    performers = gallery['performers']
+    scenes = scene_records(gallery['scenes'])
+    performers = performer_records(gallery['performers'])
 
     for scene in scenes:
         add_scene_directory_item(scene, label_format='[I]Scene:[/I] {title}')
 
-    for performer in performers:
-        add_performer_directory_item(performer, label_format='[I]Performer:[/I] {name}')
+    add_performer_directory_items(performers, label_format='[I]Performer:[/I] {name}')
 
 
     for image in images:
         title = image['title']
 
-        item = xbmcgui.ListItem(label=title)
+        item = list_item(title)
 
         item.setInfo('image', {
             'title': title,
-            'url': image['paths']['image']
+            'url': image_url(image['paths']['image'], 'screen')
+        })
+
+        item.setArt({
+            'thumb': image_url(image['paths']['image'], 'thumb')
         })
         #
         item.setProperty('IsPlayable', 'true')
@@ -762,85 +1349,89 @@ def gallery_contents(gallery_id: str):
 
         item.setProperty('mimetype', 'image/jpeg')
 
-        xbmcplugin.addDirectoryItem(plugin.handle, '', item)
+        add_directory_item('', item)
 
 
 
 
-    xbmcplugin.endOfDirectory(plugin.handle)
+    end_of_directory()
 
     # xbmc.executebuiltin("Container.SetViewMode(500)")
 
-@plugin.route('/galleries')
+@route('/galleries')
 def list_galleries():
-    query = gql(
-        GalleryFragment +
-        """
-            query ListGalleries($organized: Boolean) {
-                allGalleries: findGalleries(filter: {per_page: 0}, gallery_filter: {organized: $organized}) {
-                    galleries {
-                        ... Gallery
-                    }
-                }
-            }
-    """
-    )
+    mirrored = find_mirrored('galleries', gallery_records)
+
+    if mirrored is not None:
+        count, galleries = mirrored
 
-    galleries = client.execute(query, {
-        'organized': hide_unorganised or None
-    })['allGalleries']['galleries']
+    elif streamed():
+        result, galleries = stream(document('ListGalleries'), {
+            'filter': find_filter('galleries'),
+            'gallery_filter': listing_filter('galleries')
+        }, ('allGalleries', 'galleries'), gallery_records)
+
+        count = result['allGalleries']['count']
+
+    else:
+        count, galleries = find_records('ListGalleries', {
+            'filter': find_filter('galleries'),
+            'gallery_filter': listing_filter('galleries')
+        }, ('allGalleries', 'galleries'), gallery_records)
 
-    xbmcplugin.setPluginCategory(plugin.handle, 'Galleries')
-    xbmcplugin.setContent(plugin.handle, 'files')
+    set_paged_category('Galleries', count)
+    set_content('files')
 
     for gallery in galleries:
         add_gallery_directory_item(gallery)
 
-    xbmcplugin.endOfDirectory(plugin.handle)
+    add_next_page_item(list_galleries, count)
 
+    end_of_directory()
 
-@plugin.route('/tags/<tag_id>')
+
+@route('/tags/<tag_id>')
 def tag_contents(tag_id: str):
-    query = gql(
-        SceneFragment + GalleryFragment +
-        """
-            query FindTag($id: ID!, $organized: Boolean) {
-                tag: findTag(id: $id) {
-                    name
-                },
-                
-                taggedScenes: findScenes(filter: {per_page: 0}, scene_filter: {tags: {value: [$id], modifier: INCLUDES}, organized: $organized}) {
-                    scenes {
-                        ... Scene
-                    }
-                },
-                
-                taggedGalleries: findGalleries(filter: {per_page: 0}, gallery_filter: {tags: {value: [$id], modifier: INCLUDES}, organized: $organized}) {
-                    galleries {
-                        ... Gallery
-                    }
-                },
-                
-                taggedMarkers: findSceneMarkers(filter: {per_page: 0}, scene_marker_filter: {tags: {value: [$id], modifier: INCLUDES}}) {
-                    scene_markers {
-                        id
-                    }
-                }
-            }
-    """
-    )
+    tag = mirror.get('tags', tag_id) if mirror is not None else None
+    mirrored_scenes = find_mirrored('scenes', scene_records, related=('tags', tag_id))
+    mirrored_galleries = find_mirrored('galleries', gallery_records, related=('tags', tag_id))
 
-    result = client.execute(query, {
-        'id': tag_id,
-        'organized': hide_unorganised or None
-    })
+    if None not in (tag, mirrored_scenes, mirrored_galleries):
+        scene_count, scenes = mirrored_scenes
+        gallery_count, galleries = mirrored_galleries
+
+    else:
+        related_scenes = {
+            'filter': find_filter(),
+            'scene_filter': listing_filter('scenes', ('tags', tag_id))
+        }
+        related_galleries = {
+            'filter': find_filter('galleries'),
+            'gallery_filter': listing_filter('galleries', ('tags', tag_id))
+        }
 
-    tag = result['tag']
-    scenes = result['taggedScenes']['scenes']
-    galleries = result['taggedGalleries']['galleries']
+        # tags listed or referenced before are already in the entity store
+        tag = tag or known('tags', [tag_id]).get(tag_id)
 
-    xbmcplugin.setPluginCategory(plugin.handle, tag['name'])
-    xbmcplugin.setContent(plugin.handle, 'files')
+        scenes, galleries, *found = execute_all([
+            (document('TaggedScenes'), related_scenes, LISTING_CACHE_TTL),
+            (document('TaggedGalleries'), related_galleries, LISTING_CACHE_TTL),
+            *([(document('FindTag'), {'id': tag_id}, DETAIL_CACHE_TTL)] if tag is None else [])
+        ])
+
+        if tag is None:
+            tag = found[0]['tag']
+
+        scene_count, scenes = scenes['taggedScenes']['count'], scene_records(scenes['taggedScenes']['scenes'])
+        gallery_count, galleries = galleries['taggedGalleries']['count'], gallery_records(
+            galleries['taggedGalleries']['galleries']
+        )
+
+    # scenes and galleries are paged side by side
+    count = max(scene_count, gallery_count)
+
+    set_paged_category(tag['name'], count)
+    set_content('files')
 
     for scene in scenes:
         add_scene_directory_item(scene, label_format='Scene: {title}')
@@ -848,42 +1439,229 @@ def tag_contents(tag_id: str):
     for gallery in galleries:
         add_gallery_directory_item(gallery, label_format='Gallery: {title}')
 
-    xbmcplugin.endOfDirectory(plugin.handle)
+    add_next_page_item(tag_contents, count, tag_id=tag_id)
+
+    end_of_directory()
 
 
-@plugin.route('/tags')
+@route('/tags')
 def list_tags():
-    query = gql(
-        """
-            query ListTags {
-                allTags: findTags(filter: {per_page: 0}) {
-                    tags {
-                        id,
-                        name
-                        image_path
-                    }
-                }
-            }
-    """
-    )
+    mirrored = find_mirrored('tags', tag_records)
 
-    tags = client.execute(query)['allTags']['tags']
+    if mirrored is not None:
+        count, tags = mirrored
 
-    xbmcplugin.setPluginCategory(plugin.handle, 'Tags')
-    xbmcplugin.setContent(plugin.handle, 'files')
+    else:
+        count, tags = find_records('ListTags', {
+            'filter': find_filter()
+        }, ('allTags', 'tags'), tag_records)
+
+    set_paged_category('Tags', count)
+    set_content('files')
 
     for tag in tags:
         add_tag_directory_item(tag)
 
-    xbmcplugin.endOfDirectory(plugin.handle)
+    add_next_page_item(list_tags, count)
+
+    end_of_directory()
+
+
+@route('/search')
+def search():
+    text = xbmcgui.Dialog().input('Search Stash')
+    if not text:
+        end_of_directory(succeeded=False)
+        return
+
+    started = time.perf_counter()
+
+    results = mirror.search(text, SEARCH_RESULT_LIMIT) if mirror is not None else None
+
+    if results is None:
+        result = execute(document('Search'), {
+            'filter': {
+                'q': text,
+                'per_page': SEARCH_RESULT_LIMIT
+            }
+        })
+
+        results = [
+            *[('scenes', scene) for scene in result['findScenes']['scenes']],
+            *[('performers', performer) for performer in result['findPerformers']['performers']],
+            *[('tags', tag) for tag in result['findTags']['tags']],
+            *[('galleries', gallery) for gallery in result['findGalleries']['galleries']]
+        ]
+
+    xbmc.log(f'Search for "{text}" found {len(results)} results in {(time.perf_counter() - started) * 1000:.0f}ms',
+             xbmc.LOGDEBUG)
+
+    records = {
+        'scenes': scene_records,
+        'galleries': gallery_records,
+        'performers': performer_records,
+        'tags': tag_records
+    }
+
+    # each kind is converted at once, so the scenes' entities are resolved together
+    converted = {kind: iter(records[kind]([e for k, e in results if k == kind])) for kind in records}
+    results = [(kind, next(converted[kind])) for kind, entity in results]
+
+    set_category(f'Search: {text}')
+    set_content('files')
+
+    fanart = performer_fanart([entity for kind, entity in results if kind == 'performers'])
+
+    for kind, entity in results:
+        if kind == 'scenes':
+            add_scene_directory_item(entity, label_format='[I]Scene:[/I] {title}')
+
+        elif kind == 'galleries':
+            add_gallery_directory_item(entity, label_format='[I]Gallery:[/I] {title}')
+
+        elif kind == 'performers':
+            add_performer_directory_item(entity, label_format='[I]Performer:[/I] {name}',
+                                         fanart_url=fanart.get(entity.id))
+
+        elif kind == 'tags':
+            add_tag_directory_item(entity, label_format='[I]Tag:[/I] {name}')
+
+    end_of_directory(cacheToDisc=False)
+
+
+def widget_scenes(sort: Optional[str], direction: Optional[str], scene_filter: Dict) -> Optional[List[Scene]]:
+    # None when Stash couldn't answer within the latency budget, widgets show nothing then rather than an error.
+    # Skins may ask for fewer items than the setting.
+    limit = max(min(int(plugin.args.get('limit', [widget_limit])[0]) or WIDGET_ITEM_LIMIT, WIDGET_ITEM_LIMIT), 1)
+
+    operation = document('WidgetScenes')
+    variables = {
+        'filter': {k: v for k, v in {'page': 1, 'per_page': limit, 'sort': sort,
+                                     'direction': direction}.items() if v is not None},
+        # filters in the widget URL apply as well
+        'scene_filter': {**listing_filter('scenes'), **scene_filter}
+    }
+
+    with trace.span('cache'):
+        key = cache.key(operation, variables) if cache is not None else None
+        entry = cache.get(key) if cache is not None else None
+
+    if entry is not None:
+        trace.count('cached')
+
+        # whatever the stale_while_revalidate setting, the home screen isn't kept waiting
+        if not entry.fresh:
+            pending_revalidations.append((key, operation, variables, WIDGET_CACHE_TTL, entry.value))
+
+        result = entry.value
+
+    elif cache is not None and not cache.claim(key, SINGLE_FLIGHT_TIMEOUT):
+        # another invocation (usually a widget refreshing alongside this one) is already sending it, as in
+        # execute_all() its response is shared through the cache, but only waited on for the latency budget
+        with trace.span('wait'):
+            shared = cache.wait(key, WIDGET_LATENCY_BUDGET)
+
+        if shared is None:
+            xbmc.log('Stash widget response not shared within the latency budget', xbmc.LOGINFO)
+            return None
+
+        trace.count('shared')
+        result = shared.value
+
+    else:
+        # only the request runs on another thread, the cache's SQLite connection stays on this one
+        import concurrent.futures
+
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        future = executor.submit(fetch, operation, variables)
+        executor.shutdown(wait=False)
+
+        try:
+            result = future.result(timeout=WIDGET_LATENCY_BUDGET.total_seconds())
+
+        except concurrent.futures.TimeoutError:
+            xbmc.log(f'Stash widget request over its {WIDGET_LATENCY_BUDGET.total_seconds():.1f}s budget',
+                     xbmc.LOGINFO)
+
+            # the claim is held until store_late_responses() has stored the response
+            if cache is not None:
+                late_responses.append((key, future))
+
+            return None
+
+        except requests.exceptions.RequestException as e:
+            xbmc.log(f'Stash widget request failed: {e}', xbmc.LOGWARNING)
+
+            if cache is not None:
+                cache.release(key)
+
+            return None
+
+        if cache is not None:
+            with trace.span('cache'):
+                cache.put(key, result, WIDGET_CACHE_TTL)
+                cache.release(key)
+
+    return scene_records(result['widgetScenes']['scenes'])
+
+
+def end_of_widget(scenes: Optional[List[Scene]]):
+    set_content('videos')
+
+    for scene in scenes or []:
+        add_scene_directory_item(scene, leaf=True)
+
+    # a failed directory isn't cached by Kodi, so the widget is asked again next time
+    end_of_directory(succeeded=scenes is not None)
+
+
+@route('/widgets/<widget>')
+def scene_widget(widget: str):
+    sort, direction, scene_filter = SCENE_WIDGETS[widget]
+
+    # a stable order within the cache period, so the cached response stays valid
+    if sort == 'random':
+        sort = f'random_{int(time.time() // WIDGET_CACHE_TTL.total_seconds())}'
+
+    end_of_widget(widget_scenes(sort, direction, scene_filter))
+
+
+@route('/widgets/tags/<tag_id>')
+def tag_widget(tag_id: str):
+    end_of_widget(widget_scenes('created_at', 'DESC', {'tags': {'value': [tag_id], 'modifier': 'INCLUDES'}}))
+
+
+@route('/cache/clear')
+def clear_cache():
+    if cache is not None:
+        cache.clear()
+
+    # the service would otherwise keep answering from its memory cache
+    if service_port:
+        try:
+            requests.post(f'http://127.0.0.1:{service_port}/cache/clear', timeout=request_timeout)
+
+        except requests.exceptions.RequestException as e:
+            xbmc.log(f'Stash service unreachable, its cache was not cleared: {e}', xbmc.LOGWARNING)
+
+    xbmcgui.Dialog().notification('Stash', 'Cache cleared', xbmcgui.NOTIFICATION_INFO)
+
+
+@route('/stats')
+def show_stats():
+    records = load_stats(profile_path / 'stats.jsonl')
+
+    xbmcgui.Dialog().textviewer('Stash performance (p50 / p95 per route)',
+                                report(records) or 'No statistics recorded yet')
 
 
-@plugin.route('/')
+@route('/')
 def list_root_items():
     xbmcplugin.setPluginCategory(plugin.handle, 'Stash')
-    xbmcplugin.setContent(plugin.handle, 'files')
+    set_content('files')
 
     items = [
+        ('Search', plugin.url_for(search)),
         ('Scenes', plugin.url_for(list_scenes)),
         ('Movies', plugin.url_for(list_movies)),
         # ('Markers', plugin.url_for(list_markers)),
@@ -894,15 +1672,18 @@ def list_root_items():
     ]
 
     for group in items:
-        item = xbmcgui.ListItem(label=group[0])
+        item = list_item(group[0])
 
         url = group[1]
-        xbmcplugin.addDirectoryItem(plugin.handle, url, item, isFolder=True)
+        add_directory_item(url, item, is_folder=True)
 
-    xbmcplugin.endOfDirectory(plugin.handle)
+    end_of_directory()
 
 
 
 
 if __name__ == '__main__':
     plugin.run()
+    prefetch_artwork()
+    store_late_responses()
+    revalidate()
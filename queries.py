@@ -0,0 +1,633 @@
+import json
+import re
+from pathlib import Path
+from typing import Dict, List
+
+# Every GraphQL operation the addon sends is defined once, here, and sent by name.
+# build.py validates them against schema/stash.graphql and ships them compiled (minified,
+# with only the fragments they spread) in queries.json, so plugin invocations never parse them.
+
+# listing tier: only what scene_directory_item renders. Studios, tags and performers repeat across a listing, so
+# they're referenced by id and resolved from the entity store (see ENTITY_SELECTIONS) instead of sent per scene.
+SceneFragment = """
+fragment Scene on Scene {
+    id,
+    title,
+    details,
+    date,
+    o_counter,
+    paths {
+        screenshot,
+        stream
+    },
+    studio {
+        id
+    },
+    tags {
+        id
+    },
+    performers {
+        id
+    },
+    file {
+        duration,
+        width,
+        height,
+        audio_codec,
+        video_codec
+    },
+    galleries {
+        id,
+        cover {
+            paths {
+                image
+            }
+        }
+    }
+}
+
+"""
+
+# detail tier: the heavy nested lists, only fetched by scene_contents
+SceneDetailFragment = """
+fragment SceneDetail on Scene {
+    ... Scene,
+
+    galleries {
+        ... GalleryDetail
+    }
+
+    studio {
+        id,
+        name,
+        image_path
+    }
+
+    tags {
+        id,
+        name,
+        image_path
+    }
+
+    scene_markers {
+        title,
+        preview,
+        seconds,
+        scene {
+            paths {
+                stream
+            },
+            file {
+                duration
+            }
+        }
+    }
+
+    performers {
+        ... Performer
+    }
+}
+
+"""
+
+# listing tier: only what gallery_directory_item renders
+GalleryFragment = """
+fragment Gallery on Gallery {
+    id,
+    title,
+    path,
+    date,
+    scenes {
+        title
+    },
+    cover {
+        paths {
+            image
+        }
+    },
+    studio {
+        name
+    }
+}
+
+"""
+
+# detail tier: every image, to pick the fanart from, only fetched for the galleries of scene_contents
+GalleryDetailFragment = """
+fragment GalleryDetail on Gallery {
+    ... Gallery,
+
+    images {
+        file {
+            width,
+            height
+        }
+        paths {
+            image
+        }
+    }
+}
+
+"""
+
+PerformerFragment = """
+fragment Performer on Performer {
+    id,
+    name,
+    image_path,
+    scene_count,
+    gallery_count
+}
+
+"""
+
+
+FindSceneQuery = """
+query FindScene($id: ID!) {
+    scene: findScene(id: $id) {
+        ... SceneDetail
+    }
+}
+"""
+
+ListScenesQuery = """
+query ListScenes($filter: FindFilterType, $scene_filter: SceneFilterType) {
+    allScenes: findScenes(filter: $filter, scene_filter: $scene_filter) {
+        count,
+        scenes {
+            ... Scene
+        }
+    }
+}
+"""
+
+FindMovieQuery = """
+query FindMovie($id: ID!, $filter: FindFilterType, $scene_filter: SceneFilterType) {
+    movie: findMovie(id: $id) {
+        name
+    },
+
+    movieScenes: findScenes(filter: $filter, scene_filter: $scene_filter) {
+        count,
+        scenes {
+            ... Scene
+        }
+    },
+}
+"""
+
+ListMoviesQuery = """
+query ListMovies($filter: FindFilterType) {
+    allMovies: findMovies(filter: $filter) {
+        count,
+        movies {
+            id,
+            name,
+            synopsis,
+            director,
+            front_image_path,
+            back_image_path,
+            date
+            studio {
+                name
+            },
+        }
+    }
+}
+"""
+
+ListMarkersQuery = """
+query ListMarkers {
+    allMarkers: findSceneMarkers(filter: {per_page: 0}) {
+        scene_markers {
+            title,
+            seconds,
+            scene {
+                title,
+                paths {
+                    stream
+                }
+            }
+            preview,
+            stream,
+
+        }
+    }
+}
+"""
+
+FindPerformerQuery = """
+query FindPerformer($id: ID!) {
+    performer: findPerformer(id: $id) {
+        id,
+        name,
+        image_path
+    }
+}
+"""
+
+PerformerScenesQuery = """
+query PerformerScenes($filter: FindFilterType, $scene_filter: SceneFilterType) {
+    performerScenes: findScenes(filter: $filter, scene_filter: $scene_filter) {
+        count,
+        scenes {
+            ... Scene
+        }
+    }
+}
+"""
+
+PerformerGalleriesQuery = """
+query PerformerGalleries($filter: FindFilterType, $gallery_filter: GalleryFilterType) {
+    performerGalleries: findGalleries(filter: $filter, gallery_filter: $gallery_filter) {
+        count,
+        galleries {
+            ... Gallery
+        }
+    }
+}
+"""
+
+ListPerformersQuery = """
+query ListPerformers($filter: FindFilterType) {
+    allPerformers: findPerformers(filter: $filter) {
+        count,
+        performers {
+            ... Performer
+        }
+    }
+}
+"""
+
+FindGalleryQuery = """
+query FindGallery($id: ID!) {
+    gallery: findGallery(id: $id) {
+        title,
+        images {
+            title,
+            file {
+                width,
+                height,
+                size
+            },
+            paths {
+                image
+            },
+            studio {
+                name
+            }
+        },
+        performers {
+            ... Performer
+        }
+        scenes {
+            ... Scene
+        }
+    }
+}
+"""
+
+ListGalleriesQuery = """
+query ListGalleries($filter: FindFilterType, $gallery_filter: GalleryFilterType) {
+    allGalleries: findGalleries(filter: $filter, gallery_filter: $gallery_filter) {
+        count,
+        galleries {
+            ... Gallery
+        }
+    }
+}
+"""
+
+FindTagQuery = """
+query FindTag($id: ID!) {
+    tag: findTag(id: $id) {
+        name
+    }
+}
+"""
+
+TaggedScenesQuery = """
+query TaggedScenes($filter: FindFilterType, $scene_filter: SceneFilterType) {
+    taggedScenes: findScenes(filter: $filter, scene_filter: $scene_filter) {
+        count,
+        scenes {
+            ... Scene
+        }
+    }
+}
+"""
+
+TaggedGalleriesQuery = """
+query TaggedGalleries($filter: FindFilterType, $gallery_filter: GalleryFilterType) {
+    taggedGalleries: findGalleries(filter: $filter, gallery_filter: $gallery_filter) {
+        count,
+        galleries {
+            ... Gallery
+        }
+    }
+}
+"""
+
+ListTagsQuery = """
+query ListTags($filter: FindFilterType) {
+    allTags: findTags(filter: $filter) {
+        count,
+        tags {
+            id,
+            name
+            image_path
+        }
+    }
+}
+"""
+
+
+# Operations looking up several ids at once give every id its own aliased field (e0, e1, ...), so each one gets
+# its own filter and page. A batch holds up to BATCH_SIZE ids, see batch_variables().
+BATCH_SIZE = 20
+
+
+def batch_query(name: str, field: str, selection: str, variables: str = '') -> str:
+    # field is formatted with the id variable of its slot, the fields of unused slots are skipped
+    declarations = ', '.join(f'$id{i}: ID!, $use{i}: Boolean!' for i in range(BATCH_SIZE))
+    slots = ''.join(f"""
+    e{i}: {field.format(id=f'$id{i}')} @include(if: $use{i}) {{{selection}}},""" for i in range(BATCH_SIZE))
+
+    return f"""
+query {name}({variables}{declarations}) {{{slots}
+}}
+"""
+
+
+def batch_variables(ids: List[str]) -> Dict:
+    # unused slots repeat the first id, which is never looked up
+    return {
+        **{f'id{i}': ids[i] if i < len(ids) else ids[0] for i in range(BATCH_SIZE)},
+        **{f'use{i}': i < len(ids) for i in range(BATCH_SIZE)}
+    }
+
+
+def batch_results(result: Dict, ids: List[str]) -> Dict[str, Dict]:
+    # id -> the field of its slot
+    return {entity_id: result[f'e{i}'] for i, entity_id in enumerate(ids)}
+
+
+# a few gallery covers of each performer on a page
+PerformerGalleryCoversQuery = batch_query(
+    'PerformerGalleryCovers',
+    'findGalleries(filter: $filter, gallery_filter: {{performers: {{value: [{id}], modifier: INCLUDES}}}})',
+    """
+        galleries {
+            cover {
+                file {
+                    width,
+                    height
+                }
+                paths {
+                    image
+                }
+            }
+        }
+    """,
+    variables='$filter: FindFilterType, '
+)
+
+
+# kind -> (find field, selection) of the performers, tags and studios listed scenes reference by id, looked up a
+# batch at a time when they aren't in the entity store yet
+ENTITY_SELECTIONS = {
+    'Performers': ('findPerformer', """
+        ... Performer
+    """),
+    'Tags': ('findTag', """
+        id,
+        name,
+        image_path
+    """),
+    'Studios': ('findStudio', """
+        id,
+        name,
+        image_path
+    """),
+}
+
+
+# home screen widgets: a handful of scenes, with their studio, tags and performers embedded, which costs less than
+# the round trip of resolving them
+WidgetScenesQuery = """
+query WidgetScenes($filter: FindFilterType, $scene_filter: SceneFilterType) {
+    widgetScenes: findScenes(filter: $filter, scene_filter: $scene_filter) {
+        scenes {
+            ... Scene,
+            studio { id, name, image_path },
+            performers { ... Performer },
+            tags { id, name, image_path }
+        }
+    }
+}
+"""
+
+
+# Stash's own search, for when there is no local library mirror
+SearchQuery = """
+query Search($filter: FindFilterType) {
+    findScenes(filter: $filter) {
+        scenes {
+            ... Scene
+        }
+    },
+    findPerformers(filter: $filter) {
+        performers {
+            ... Performer
+        }
+    },
+    findTags(filter: $filter) {
+        tags {
+            id,
+            name,
+            image_path
+        }
+    },
+    findGalleries(filter: $filter) {
+        galleries {
+            ... Gallery
+        }
+    }
+}
+"""
+
+
+# (find field, filter argument, result field, selection) of every kind the library mirror syncs
+MIRRORED_SELECTIONS = {
+    'Scenes': ('findScenes', 'scene_filter', 'scenes', """
+        ... Scene,
+        organized,
+        studio { id, name, image_path },
+        performers { id, name, image_path },
+        tags { id, name },
+        movies { movie { id } }
+    """),
+    'Galleries': ('findGalleries', 'gallery_filter', 'galleries', """
+        ... Gallery,
+        organized,
+        performers { id },
+        tags { id }
+    """),
+    'Performers': ('findPerformers', 'performer_filter', 'performers', """
+        ... Performer
+    """),
+    'Tags': ('findTags', 'tag_filter', 'tags', """
+        name,
+        image_path
+    """),
+    'Movies': ('findMovies', 'movie_filter', 'movies', """
+        name,
+        synopsis,
+        director,
+        front_image_path,
+        back_image_path,
+        date,
+        studio { name }
+    """),
+    'Studios': ('findStudios', 'studio_filter', 'studios', """
+        name,
+        image_path
+    """),
+}
+
+
+def mirror_queries(kind: str) -> List[str]:
+    find_field, filter_argument, result_field, selection = MIRRORED_SELECTIONS[kind]
+
+    return [
+        f"""
+        query Mirror{kind}($filter: FindFilterType, $since: String!) {{
+            changed: {find_field}(filter: $filter, {filter_argument}: {{updated_at: {{value: $since, modifier: GREATER_THAN}}}}) {{
+                count,
+                {result_field} {{
+                    id,
+                    updated_at,
+                    {selection}
+                }}
+            }},
+
+            total: {find_field}(filter: {{per_page: 1}}) {{
+                count
+            }}
+        }}
+        """,
+        f"""
+        query Mirror{kind}Ids {{
+            all: {find_field}(filter: {{per_page: 0}}) {{
+                {result_field} {{
+                    id,
+                    updated_at
+                }}
+            }}
+        }}
+        """
+    ]
+
+
+FRAGMENTS = [
+    SceneFragment,
+    SceneDetailFragment,
+    GalleryFragment,
+    GalleryDetailFragment,
+    PerformerFragment
+]
+
+OPERATIONS = [
+    FindSceneQuery,
+    ListScenesQuery,
+    FindMovieQuery,
+    ListMoviesQuery,
+    ListMarkersQuery,
+    FindPerformerQuery,
+    PerformerScenesQuery,
+    PerformerGalleriesQuery,
+    ListPerformersQuery,
+    FindGalleryQuery,
+    ListGalleriesQuery,
+    FindTagQuery,
+    TaggedScenesQuery,
+    TaggedGalleriesQuery,
+    ListTagsQuery,
+    PerformerGalleryCoversQuery,
+    *[batch_query(f'Entity{kind}', f'{field}(id: {{id}})', selection)
+      for kind, (field, selection) in ENTITY_SELECTIONS.items()],
+    WidgetScenesQuery,
+    SearchQuery,
+    *[query for kind in MIRRORED_SELECTIONS for query in mirror_queries(kind)]
+]
+
+# written by build.py, a source checkout compiles documents on first use instead
+COMPILED_PATH = Path(__file__).parent / 'queries.json'
+
+TOKEN = re.compile(r'"(?:[^"\\]|\\.)*"|\.\.\.|[!$&()\[\]{}:=@|]|-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?|\w+')
+
+
+def tokenize(source: str) -> List[str]:
+    # commas and comments are insignificant in GraphQL documents
+    return TOKEN.findall(re.sub(r'#[^\n]*', '', source))
+
+
+def minify(tokens: List[str]) -> str:
+    document = ''
+    previous = ''
+
+    for token in tokens:
+        # names and numbers are the only tokens that need a separator
+        if re.match(r'[-+\w]', token) and re.match(r'[-+\w]', previous[:1]):
+            document += ' '
+
+        document += token
+        previous = token
+
+    return document
+
+
+def definitions(sources: List[str]) -> Dict[str, List[str]]:
+    # definition name -> tokens, for sources that each hold one definition
+    return {tokens[1]: tokens for tokens in map(tokenize, sources)}
+
+
+def spreads(tokens: List[str]) -> List[str]:
+    return [name for spread, name in zip(tokens, tokens[1:]) if spread == '...' and name != 'on']
+
+
+def compile_query(name: str) -> str:
+    fragments = definitions(FRAGMENTS)
+    tokens = definitions(OPERATIONS)[name]
+
+    # fragments spread by the operation, and by those fragments in turn
+    used = []
+    pending = spreads(tokens)
+    while pending:
+        fragment = pending.pop(0)
+        if fragment in used:
+            continue
+
+        used.append(fragment)
+        pending.extend(spreads(fragments[fragment]))
+
+    return ' '.join(minify(t) for t in [tokens, *[fragments[f] for f in used]])
+
+
+def compile_queries() -> Dict[str, str]:
+    return {name: compile_query(name) for name in definitions(OPERATIONS)}
+
+
+compiled = None
+
+
+def document(name: str) -> str:
+    global compiled
+
+    if compiled is None:
+        compiled = json.loads(COMPILED_PATH.read_text()) if COMPILED_PATH.exists() else {}
+
+    if name not in compiled:
+        compiled[name] = compile_query(name)
+
+    return compiled[name]
@@ -0,0 +1,119 @@
+import sys
+from pathlib import Path
+from typing import Dict, NamedTuple, Optional, Tuple
+
+# Compact, tuple-backed versions of the Stash objects the directory items are built from. They hold only the
+# fields the views render, nested lists are reduced to what is derived from them (names, the chosen fanart),
+# and repeated strings (tag, performer and studio names) are interned, so a listing doesn't keep the decoded
+# response alive.
+
+
+def intern(value: Optional[str]) -> Optional[str]:
+    return sys.intern(value) if value is not None else None
+
+
+class Scene(NamedTuple):
+    id: str
+    title: Optional[str]
+    details: Optional[str]
+    date: Optional[str]
+    o_counter: Optional[int]
+    screenshot: Optional[str]
+    stream: str
+    studio_name: Optional[str]
+    studio_image: Optional[str]
+    tag_names: Tuple[str, ...]
+    # (name, image_path) of each performer
+    cast: Tuple[Tuple[str, Optional[str]], ...]
+    duration: Optional[float]
+    width: Optional[int]
+    height: Optional[int]
+    audio_codec: Optional[str]
+    video_codec: Optional[str]
+    fanart: Optional[str]
+
+    @classmethod
+    def decode(cls, scene: Dict, fanart: Optional[str] = None) -> 'Scene':
+        studio = scene['studio'] or {}
+        file = scene['file']
+
+        return cls(
+            id=scene['id'],
+            title=scene['title'],
+            details=scene['details'],
+            date=scene['date'],
+            o_counter=scene['o_counter'],
+            screenshot=scene['paths']['screenshot'],
+            stream=scene['paths']['stream'],
+            studio_name=intern(studio.get('name')),
+            studio_image=intern(studio.get('image_path')),
+            tag_names=tuple(intern(t['name']) for t in scene['tags']),
+            cast=tuple((intern(p['name']), intern(p['image_path'])) for p in scene['performers']),
+            duration=file['duration'],
+            width=file['width'],
+            height=file['height'],
+            audio_codec=intern(file['audio_codec']),
+            video_codec=intern(file['video_codec']),
+            fanart=fanart
+        )
+
+
+class Gallery(NamedTuple):
+    id: str
+    title: str
+    studio_name: Optional[str]
+    cover: Optional[str]
+    fanart: Optional[str]
+
+    @classmethod
+    def decode(cls, gallery: Dict, fanart: Optional[str] = None) -> 'Gallery':
+        def title():
+            if gallery['title'] is not None:
+                return gallery['title']
+
+            first_scene = next(iter(gallery['scenes']), None)
+            discriminator = first_scene["title"] if first_scene else Path(gallery['path']).name
+            return f'Untitled Gallery ({discriminator})'
+
+        studio = gallery['studio'] or {}
+        cover = gallery['cover']
+
+        return cls(
+            id=gallery['id'],
+            title=title(),
+            studio_name=intern(studio.get('name')),
+            cover=cover['paths']['image'] if cover is not None else None,
+            fanart=fanart
+        )
+
+
+class Performer(NamedTuple):
+    id: str
+    name: str
+    image_path: Optional[str]
+    scene_count: int
+    gallery_count: int
+
+    @classmethod
+    def decode(cls, performer: Dict) -> 'Performer':
+        return cls(
+            id=performer['id'],
+            name=intern(performer['name']),
+            image_path=intern(performer['image_path']),
+            scene_count=performer['scene_count'],
+            gallery_count=performer['gallery_count']
+        )
+
+
+class Tag(NamedTuple):
+    id: str
+    name: str
+    image_path: Optional[str]
+
+    @classmethod
+    def decode(cls, tag: Dict) -> 'Tag':
+        return cls(
+            id=tag['id'],
+            name=intern(tag['name']),
+            image_path=intern(tag['image_path'])
+        )
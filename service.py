@@ -0,0 +1,398 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urljoin, urlsplit
+import xbmc
+import xbmcaddon
+import xbmcgui
+import xbmcvfs
+import requests
+from mirror import LibraryMirror
+from stash_client import (SERVICE_PORT_PROPERTY, StashClient, StashError, Transfer, operation_name, stash_session,
+                          transfer_of)
+from thumbnails import THUMBNAIL_SIZES, ThumbnailCache, content_type, resize
+
+MEMORY_CACHE_TTL = timedelta(minutes=5)
+MEMORY_CACHE_ENTRIES = 200
+
+# a stable port keeps image URLs (and so Kodi's texture cache) valid across restarts
+PREFERRED_SERVICE_PORT = 57342
+
+PREFETCH_WORKERS = 4
+
+
+def log_transfer(transfer: Transfer):
+    xbmc.log(f'{transfer.operation}: {transfer.transferred} bytes transferred, {transfer.decoded} decoded '
+             f'in {transfer.elapsed * 1000:.0f}ms', xbmc.LOGDEBUG)
+
+
+class MemoryCache:
+    def __init__(self, max_entries: int, ttl: timedelta):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+
+            expires_at, body = entry
+            if expires_at < time.monotonic():
+                del self.entries[key]
+                return None
+
+            self.entries.move_to_end(key)
+            return body
+
+    def put(self, key: str, body: bytes):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl.total_seconds(), body)
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class RateLimiter:
+    # blocks consumers so that on average no more than rate units per second go through
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.available_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, amount: int):
+        if self.rate <= 0:
+            return
+
+        with self.lock:
+            now = time.monotonic()
+            self.available_at = max(self.available_at, now) + amount / self.rate
+            delay = self.available_at - now
+
+        time.sleep(delay)
+
+
+class StashProxy:
+    def __init__(self, profile_path: Path):
+        self.profile_path = profile_path
+
+        # enough pooled keep-alive connections for concurrent plugin invocations
+        self.session = stash_session(pool_maxsize=8)
+
+        self.cache = MemoryCache(MEMORY_CACHE_ENTRIES, MEMORY_CACHE_TTL)
+
+        # request body hash -> lock held while it's sent to Stash, identical concurrent requests wait for it
+        self.inflight = {}
+        self.inflight_lock = threading.Lock()
+
+        # image url -> lock held while the original is downloaded and resized, other variants wait for it
+        self.downloads = {}
+        self.downloads_lock = threading.Lock()
+
+        self.configure()
+
+    def configure(self):
+        addon = xbmcaddon.Addon()
+
+        self.graphql_url = urljoin(addon.getSetting('url'), '/graphql')
+        self.client = StashClient(self.graphql_url, int(addon.getSetting('request_timeout') or 0) or None,
+                                  self.session)
+        self.timeout = self.client.timeout
+        self.cache.clear()
+
+        thumbnail_cache_size = int(addon.getSetting('thumbnail_cache_size') or 0) * 1024 * 1024
+        self.thumbnails = ThumbnailCache(self.profile_path / 'thumbnails', thumbnail_cache_size)
+
+    def graphql(self, body: bytes, fresh: bool = False) -> Tuple[int, bytes]:
+        # fresh bypasses the memory cache (the plugin revalidating a stale response), the answer still replaces it
+        key = hashlib.sha256(body).hexdigest()
+
+        cached = None if fresh else self.cache.get(key)
+        if cached is not None:
+            return 200, cached
+
+        with self.inflight_lock:
+            lock = self.inflight.setdefault(key, threading.Lock())
+
+        try:
+            with lock:
+                # answered while this one waited
+                cached = None if fresh else self.cache.get(key)
+                if cached is not None:
+                    return 200, cached
+
+                return self.send(body, key)
+
+        finally:
+            with self.inflight_lock:
+                if self.inflight.get(key) is lock:
+                    del self.inflight[key]
+
+    def send(self, body: bytes, key: str) -> Tuple[int, bytes]:
+        started = time.perf_counter()
+
+        response = self.session.post(self.graphql_url, data=body, timeout=self.timeout,
+                                     headers={'Content-Type': 'application/json'})
+        elapsed = time.perf_counter() - started
+
+        # the body is relayed untouched, the operation name is found in its JSON text just as well
+        operation = operation_name(body.decode('utf-8', 'replace'))
+        log_transfer(transfer_of(operation, response, len(response.content), elapsed))
+
+        if response.status_code == 200 and 'errors' not in response.json():
+            self.cache.put(key, response.content)
+
+        return response.status_code, response.content
+
+    def image(self, url: str, variant: str, limiter: Optional[RateLimiter] = None) -> Optional[bytes]:
+        # only images served by Stash itself, this must not become an open proxy
+        if urlsplit(url).netloc != urlsplit(self.graphql_url).netloc or variant not in THUMBNAIL_SIZES:
+            return None
+
+        data = self.thumbnails.get(url, variant)
+        if data is not None:
+            return data
+
+        with self.downloads_lock:
+            lock = self.downloads.setdefault(url, threading.Lock())
+
+        try:
+            with lock:
+                # written by the download this one waited for
+                data = self.thumbnails.get(url, variant)
+                if data is not None:
+                    return data
+
+                return self.download(url, limiter)[variant]
+
+        finally:
+            with self.downloads_lock:
+                if self.downloads.get(url) is lock:
+                    del self.downloads[url]
+
+    def download(self, url: str, limiter: Optional[RateLimiter]) -> Dict[str, bytes]:
+        # originals are large (photos of 20 MB), so every variant is written from a single download
+        response = self.session.get(url, timeout=self.timeout)
+        response.raise_for_status()
+
+        if limiter is not None:
+            limiter.consume(len(response.content))
+
+        variants = {variant: resize(response.content, size) for variant, size in THUMBNAIL_SIZES.items()}
+
+        for variant, data in variants.items():
+            self.thumbnails.put(url, variant, data)
+
+        return variants
+
+
+class ArtworkPrefetcher:
+    # fills the thumbnail cache ahead of Kodi asking for the images
+
+    def __init__(self, proxy: StashProxy):
+        self.proxy = proxy
+        self.executor = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix='prefetch')
+        self.limiter = RateLimiter(0)
+        self.generation = 0
+        self.player = xbmc.Player()
+        self.configure()
+
+    def configure(self):
+        self.limiter.rate = int(xbmcaddon.Addon().getSetting('prefetch_rate') or 0) * 1024  # KiB/s
+
+    def prefetch(self, images: List[Tuple[str, str]]):
+        # a newly listed directory supersedes whatever is still queued for the previous one
+        self.generation += 1
+
+        for url, variant in images:
+            self.executor.submit(self.fetch, self.generation, url, variant)
+
+    def fetch(self, generation: int, url: str, variant: str):
+        # playback gets the bandwidth
+        if generation != self.generation or self.player.isPlayingVideo():
+            return
+
+        try:
+            self.proxy.image(url, variant, self.limiter)
+
+        except (requests.exceptions.RequestException, OSError) as e:
+            xbmc.log(f'Stash artwork prefetch failed: {e}', xbmc.LOGDEBUG)
+
+    def shutdown(self):
+        self.generation += 1
+        self.executor.shutdown(wait=False)
+
+
+def request_handler(proxy: StashProxy, prefetcher: ArtworkPrefetcher):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            if self.path == '/prefetch':
+                images = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                prefetcher.prefetch([(url, variant) for url, variant in images])
+
+                self.send_response(202)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+
+            # the plugin's Clear cache action, which clears its disk cache itself
+            if self.path == '/cache/clear':
+                proxy.cache.clear()
+
+                self.send_response(204)
+                self.end_headers()
+                return
+
+            if self.path != '/graphql':
+                self.send_error(404)
+                return
+
+            body = self.rfile.read(int(self.headers['Content-Length']))
+
+            try:
+                status, content = proxy.graphql(body, fresh='no-cache' in self.headers.get('Cache-Control', ''))
+
+            except requests.exceptions.RequestException as e:
+                xbmc.log(f'Stash request failed: {e}', xbmc.LOGWARNING)
+                self.send_error(502)
+                return
+
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            if url.path != '/image':
+                self.send_error(404)
+                return
+
+            args = parse_qs(url.query)
+
+            try:
+                content = proxy.image(args.get('url', [''])[0], args.get('size', [''])[0])
+
+            # OSError covers images PIL can't decode
+            except (requests.exceptions.RequestException, OSError) as e:
+                xbmc.log(f'Stash image request failed: {e}', xbmc.LOGWARNING)
+                self.send_error(502)
+                return
+
+            if content is None:
+                self.send_error(403)
+                return
+
+            self.send_response(200)
+            self.send_header('Content-Type', content_type(content))
+            self.send_header('Content-Length', str(len(content)))
+            self.send_header('Cache-Control', 'max-age=86400')
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, format, *args):
+            xbmc.log(f'Stash service: {format % args}', xbmc.LOGDEBUG)
+
+    return Handler
+
+
+class ServiceMonitor(xbmc.Monitor):
+    def __init__(self):
+        super().__init__()
+
+        self.profile_path = Path(xbmcvfs.translatePath(xbmcaddon.Addon().getAddonInfo('profile')))
+        self.profile_path.mkdir(parents=True, exist_ok=True)
+
+        self.proxy = StashProxy(self.profile_path)
+        self.prefetcher = ArtworkPrefetcher(self.proxy)
+        self.server = None
+        self.window = xbmcgui.Window(10000)
+
+    def start(self):
+        if xbmcaddon.Addon().getSetting('use_service') != 'true':
+            return
+
+        try:
+            self.server = ThreadingHTTPServer(('127.0.0.1', PREFERRED_SERVICE_PORT), request_handler(self.proxy, self.prefetcher))
+
+        except OSError:
+            self.server = ThreadingHTTPServer(('127.0.0.1', 0), request_handler(self.proxy, self.prefetcher))
+
+        self.server.daemon_threads = True
+
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        port = self.server.server_address[1]
+        self.window.setProperty(SERVICE_PORT_PROPERTY, str(port))
+
+        xbmc.log(f'Stash service listening on port {port}', xbmc.LOGINFO)
+
+    def stop(self):
+        self.window.clearProperty(SERVICE_PORT_PROPERTY)
+
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def onSettingsChanged(self):
+        self.stop()
+        self.proxy.configure()
+        self.prefetcher.configure()
+        self.start()
+
+    def sync_interval(self) -> Optional[timedelta]:
+        addon = xbmcaddon.Addon()
+        if addon.getSetting('mirror_enabled') != 'true':
+            return None
+
+        return timedelta(minutes=max(int(addon.getSetting('mirror_interval') or 0), 1))
+
+    def sync_library(self):
+        if self.sync_interval() is None:
+            return
+
+        started = time.monotonic()
+
+        try:
+            LibraryMirror(self.profile_path / 'library.db').sync(self.proxy.client.execute, self.abortRequested)
+
+        except (requests.exceptions.RequestException, StashError) as e:
+            xbmc.log(f'Stash library sync failed: {e}', xbmc.LOGWARNING)
+            return
+
+        xbmc.log(f'Stash library synced in {time.monotonic() - started:.1f}s', xbmc.LOGINFO)
+
+
+if __name__ == '__main__':
+    monitor = ServiceMonitor()
+    monitor.start()
+
+    while not monitor.abortRequested():
+        monitor.sync_library()
+
+        # settings are re-read every round, so toggling the mirror doesn't need a restart
+        interval = monitor.sync_interval() or timedelta(minutes=1)
+        if monitor.waitForAbort(interval.total_seconds()):
+            break
+
+    monitor.stop()
+    monitor.prefetcher.shutdown()
@@ -0,0 +1,319 @@
+import codecs
+import json
+import re
+import time
+from typing import Callable, Dict, Iterable, Iterator, NamedTuple, Optional, Sequence, Tuple
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.request import ACCEPT_ENCODING
+from urllib3.util.retry import Retry
+
+# the plugin looks up the background service's port in this home window property
+SERVICE_PORT_PROPERTY = 'stash.service.port'
+
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Stash is usually on the local network, an unreachable server should fail fast
+CONNECT_TIMEOUT = 5  # seconds
+
+# the addon only sends queries, so POSTs are as safe to repeat as GETs. Only responses saying Stash is briefly
+# unavailable are retried a few times: a read timeout is never retried, and a failed connection once, so a slow or
+# unreachable Stash fails within about the configured timeout and cached responses are served instead.
+RETRIES = 3
+CONNECT_RETRIES = 1
+RETRY_BACKOFF = 0.5  # seconds, doubled on every retry
+RETRY_STATUSES = (502, 503, 504)
+RETRY_METHODS = frozenset(['GET', 'POST'])
+
+
+class StashError(Exception):
+    pass
+
+
+def stash_error(errors) -> StashError:
+    return StashError('; '.join(e.get('message', str(e)) for e in errors))
+
+
+class Transfer(NamedTuple):
+    operation: str
+    transferred: int  # response body bytes as received, before content decoding
+    decoded: int
+    elapsed: float  # seconds on the network, until the last byte arrived
+    decoding: float  # seconds spent decoding the JSON
+
+
+TransferHandler = Callable[[Transfer], None]
+
+
+def operation_name(document: str) -> str:
+    match = re.search(r'\b(?:query|mutation)\s+(\w+)', document)
+
+    return match.group(1) if match is not None else 'anonymous'
+
+
+def transfer_of(operation: str, response: requests.Response, decoded: int, elapsed: float,
+                decoding: float = 0.0) -> Transfer:
+    # urllib3 counts the bytes it read off the connection, i.e. still compressed
+    return Transfer(operation, response.raw.tell(), decoded, elapsed, decoding)
+
+
+def timed(iterator: Iterable, spent: Callable[[float], None]) -> Iterator:
+    # yields from iterator, reporting the time each element took to produce
+    iterator = iter(iterator)
+    end = object()
+
+    while True:
+        started = time.perf_counter()
+        element = next(iterator, end)
+        spent(time.perf_counter() - started)
+
+        if element is end:
+            return
+
+        yield element
+
+
+def retry_policy(retries: int) -> Retry:
+    options = {
+        'total': retries,
+        'connect': min(retries, CONNECT_RETRIES),
+        'read': 0,
+        'backoff_factor': RETRY_BACKOFF,
+        'status_forcelist': RETRY_STATUSES,
+        # the last response is handed back as is, its GraphQL errors are more telling than a MaxRetryError
+        'raise_on_status': False
+    }
+
+    try:
+        return Retry(allowed_methods=RETRY_METHODS, **options)
+
+    except TypeError:
+        # urllib3 < 1.26, as shipped with Kodi 19
+        return Retry(method_whitelist=RETRY_METHODS, **options)
+
+
+def stash_session(retries: int = RETRIES, pool_maxsize: int = 4) -> requests.Session:
+    session = requests.Session()
+
+    # gzip and deflate, plus brotli and zstd when their modules are installed, GraphQL responses compress ~10x
+    session.headers['Accept-Encoding'] = ACCEPT_ENCODING
+
+    adapter = HTTPAdapter(max_retries=retry_policy(retries), pool_connections=2, pool_maxsize=pool_maxsize)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    return session
+
+
+class ListStream:
+    # incrementally decodes a JSON response, yielding the elements of one list (e.g. data.allScenes.scenes)
+    # as they arrive, so that neither the body nor the full decoded response is ever held in memory
+
+    decoder = json.JSONDecoder()
+
+    def __init__(self, chunks: Iterable[bytes]):
+        self.chunks = iter(chunks)
+        self.text = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def more(self) -> bool:
+        if self.eof:
+            return False
+
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            self.eof = True
+            self.buffer += self.text.decode(b'', final=True)
+            return True
+
+        # drop what was parsed already, it's only ever read forward
+        self.buffer = self.buffer[self.pos:] + self.text.decode(chunk)
+        self.pos = 0
+        return True
+
+    def peek(self) -> Optional[str]:
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in ' \t\r\n':
+                self.pos += 1
+
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+
+            if not self.more():
+                return None
+
+    def expect(self, char: str):
+        if self.peek() != char:
+            raise StashError(f'Unexpected response from Stash, expected "{char}"')
+
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+
+                # a number at the end of the buffer may continue in the next chunk
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+
+            self.more()
+
+    def members(self) -> Iterator[str]:
+        # keys of the object at the current position, the caller consumes each value
+        self.expect('{')
+
+        while self.peek() != '}':
+            key = self.value()
+            self.expect(':')
+
+            yield key
+
+            if self.peek() == ',':
+                self.pos += 1
+
+        self.pos += 1
+
+    def find(self, path: Sequence[str], fields: Dict) -> bool:
+        # descends to the list at path, collecting the values that come before it into fields
+        for key in self.members():
+            if key != path[0]:
+                fields[key] = self.value()
+
+            elif len(path) == 1:
+                self.expect('[')
+                return True
+
+            elif self.peek() == '{' and self.find(path[1:], fields.setdefault(key, {})):
+                return True
+
+            else:
+                fields[key] = self.value()
+
+        return False
+
+    def elements(self) -> Iterator:
+        while self.peek() != ']':
+            yield self.value()
+
+            if self.peek() == ',':
+                self.pos += 1
+
+
+class StashClient:
+    # posts query documents as-is: no parsing or validation, Stash does that anyway
+
+    def __init__(self, url: str, timeout: Optional[float] = None, session: requests.Session = None,
+                 on_transfer: TransferHandler = None):
+        self.url = url
+        # timeout only limits the wait for response data, connecting is limited separately
+        self.timeout = (CONNECT_TIMEOUT, timeout)
+        self.session = session or stash_session()
+        self.on_transfer = on_transfer
+
+    def transferred(self, transfer: Transfer):
+        if self.on_transfer is not None:
+            self.on_transfer(transfer)
+
+    def execute(self, document: str, variables: Dict = None, fresh: bool = False) -> Dict:
+        # fresh asks the background service not to answer from its memory cache, Stash ignores it
+        started = time.perf_counter()
+
+        response = self.session.post(self.url, json={'query': document, 'variables': variables or {}},
+                                     timeout=self.timeout, headers={'Cache-Control': 'no-cache'} if fresh else None)
+        size = len(response.content)
+        elapsed = time.perf_counter() - started
+
+        try:
+            return self.data(response)
+
+        finally:
+            decoding = time.perf_counter() - started - elapsed
+            self.transferred(transfer_of(operation_name(document), response, size, elapsed, decoding))
+
+    @staticmethod
+    def data(response: requests.Response) -> Dict:
+        try:
+            result = response.json()
+
+        except ValueError:
+            response.raise_for_status()
+            raise
+
+        # validation errors come with a 4xx status, but still have a GraphQL body
+        if result.get('errors'):
+            raise stash_error(result['errors'])
+
+        response.raise_for_status()
+
+        return result['data']
+
+    def stream(self, document: str, variables: Dict, path: Sequence[str]) -> Tuple[Dict, Iterator[Dict]]:
+        # returns the data fields before the list at path (like the count), and an iterator over the list
+        started = time.perf_counter()
+
+        response = self.session.post(self.url, json={'query': document, 'variables': variables or {}},
+                                     timeout=self.timeout, stream=True)
+
+        if response.status_code != 200:
+            with response:
+                self.data(response)
+
+            raise StashError(f'Unexpected response status {response.status_code} from Stash')
+
+        requested = time.perf_counter() - started
+
+        # the body is decoded while it arrives: parsing time includes the waits for chunks
+        waiting = 0.0
+        parsing = 0.0
+        size = 0
+
+        def waited(seconds: float):
+            nonlocal waiting
+            waiting += seconds
+
+        def parsed(seconds: float):
+            nonlocal parsing
+            parsing += seconds
+
+        def chunks():
+            nonlocal size
+
+            for chunk in timed(response.iter_content(STREAM_CHUNK_SIZE), waited):
+                size += len(chunk)
+                yield chunk
+
+        stream = ListStream(chunks())
+        fields = {}
+
+        parse_started = time.perf_counter()
+        found = stream.find(['data', *path], fields)
+        parsed(time.perf_counter() - parse_started)
+
+        # Stash sends errors ahead of data
+        if fields.get('errors'):
+            response.close()
+            raise stash_error(fields['errors'])
+
+        if not found:
+            response.close()
+            raise StashError(f'Response from Stash is missing {".".join(path)}')
+
+        def elements():
+            with response:
+                yield from timed(stream.elements(), parsed)
+
+            self.transferred(transfer_of(operation_name(document), response, size, requested + waiting,
+                                         parsing - waiting))
+
+        return fields['data'], elements()
@@ -0,0 +1,109 @@
+import hashlib
+import io
+import os
+import threading
+from pathlib import Path
+from typing import Optional
+
+try:
+    from PIL import Image
+
+except ImportError:
+    # script.module.pil is optional, without it the originals are cached as they are
+    Image = None
+
+# longest edge of each variant, in pixels
+THUMBNAIL_SIZES = {
+    'thumb': 480,
+    'screen': 1920
+}
+
+
+def resize(data: bytes, size: int) -> bytes:
+    if Image is None:
+        return data
+
+    image = Image.open(io.BytesIO(data))
+    if max(image.size) <= size:
+        return data
+
+    image.thumbnail((size, size))
+
+    output = io.BytesIO()
+    image.convert('RGB').save(output, 'JPEG', quality=85)
+
+    return output.getvalue()
+
+
+def content_type(data: bytes) -> str:
+    if data.startswith(b'\x89PNG'):
+        return 'image/png'
+
+    if data.startswith(b'GIF8'):
+        return 'image/gif'
+
+    if data[8:12] == b'WEBP':
+        return 'image/webp'
+
+    return 'image/jpeg'
+
+
+class ThumbnailCache:
+    # resized images on disk, least recently used files are deleted once max_size is exceeded
+
+    def __init__(self, path: Path, max_size: int):
+        self.path = path
+        self.max_size = max_size
+        self.lock = threading.Lock()
+
+        path.mkdir(parents=True, exist_ok=True)
+        self.size = sum(f.stat().st_size for f in path.iterdir())
+
+    def file(self, url: str, variant: str) -> Path:
+        return self.path / hashlib.sha1(f'{variant}:{url}'.encode('utf-8')).hexdigest()
+
+    def get(self, url: str, variant: str) -> Optional[bytes]:
+        file = self.file(url, variant)
+
+        try:
+            data = file.read_bytes()
+
+        except FileNotFoundError:
+            return None
+
+        # the modification time doubles as the last access time
+        os.utime(file)
+
+        return data
+
+    def put(self, url: str, variant: str, data: bytes):
+        file = self.file(url, variant)
+
+        # written aside first, so concurrent readers never see a partial image
+        temporary = file.with_suffix(f'.{threading.get_ident()}.tmp')
+        temporary.write_bytes(data)
+        temporary.replace(file)
+
+        with self.lock:
+            self.size += len(data)
+
+            if self.size > self.max_size:
+                self.evict()
+
+    def evict(self):
+        files = []
+        for f in self.path.iterdir():
+            try:
+                files.append((f.stat(), f))
+
+            except FileNotFoundError:
+                continue
+
+        self.size = sum(stat.st_size for stat, f in files)
+
+        for stat, f in sorted(files, key=lambda e: e[0].st_mtime):
+            if self.size <= self.max_size:
+                break
+
+            f.unlink(missing_ok=True)
+            self.size -= stat.st_size